@@ -67,6 +67,7 @@ except ImportError:
 # import yaml as needed
 #import yaml
 import copy
+import hashlib
 import shlex
 import subprocess
 import signal
@@ -102,13 +103,42 @@ SERVER_CONF_FILENAME="/etc/lcserver.conf"
 # and https://bugs.python.org/issue27777
 # Use this instead of cgi.FieldStorage() class
 # Right now, the only attributes used are form.value and form.getfirst()
+# The data can be passed as bytes, or as a file object (fp) and length.
+# In the latter case, the data is only read from fp when form.value is
+# used, so that large request bodies (e.g. uploads) can be processed as
+# a stream with get_stream() instead.
 class mycgiform_class:
-    def __init__(self, data):
-        self.value = data
+    def __init__(self, data=b"", fp=None, length=-1, query_string=""):
+        self._value = data
+        self.fp = fp
+        self.length = length
+        self.query = urllib.parse.parse_qs(query_string)
+
+    @property
+    def value(self):
+        if self.fp:
+            self._value = self.fp.read(self.length)
+            self.fp = None
+        return self._value
+
+    # return (fp, length) for reading the data
+    # length is -1 if the length is unknown
+    def get_stream(self):
+        if self.fp:
+            fp = self.fp
+            self.fp = None
+            return (fp, self.length)
+
+        import io
+        return (io.BytesIO(self._value), len(self._value))
 
     def getfirst(self, attr, default=None):
         if attr=="action":
             return "api"
+        # values from the query string are available for raw data
+        # requests (e.g. upload chunks)
+        if attr in self.query:
+            return self.query[attr][0]
         return default
 
 # define a class for config vars
@@ -142,6 +172,66 @@ class config_class:
         self.default_reservation_duration = "forever"
         self.default_video_recording_duration = "10"
 
+        # status probes (power, network and command status) are run
+        # in parallel, with a per-probe timeout (in seconds)
+        self.status_probe_timeout = "10"
+        self.status_probe_workers = "8"
+
+        # board status is polled in the background (see --poll), and
+        # cached status results are used if they are newer than
+        # status_cache_ttl seconds.  Intervals are in seconds.
+        self.status_poll_interval = "60"
+        self.status_poll_jitter = "10"
+        self.status_cache_ttl = "180"
+
+        # event stream settings: maximum size of the event log before it
+        # is rotated (in bytes), and maximum duration of a single event
+        # stream connection (in seconds)
+        self.events_log_max_size = "1000000"
+        self.events_max_duration = "3600"
+
+        # how long to keep the output of finished jobs (in seconds)
+        self.job_retention = "86400"
+
+        # maximum total size of the upload blob store (in bytes)
+        self.blob_store_max_size = "1000000000"
+
+        # maximum number of boards to upload to at the same time
+        # (for multi-board uploads)
+        self.upload_workers = "8"
+
+        # time (in seconds) to keep unused upload sessions
+        self.upload_session_retention = "86400"
+
+        # maximum size (in bytes) of a file sent with an upload session,
+        # and maximum number of upload sessions for each user
+        self.upload_session_max_size = "1000000000"
+        self.upload_session_max_count = "4"
+
+        # time (in seconds) to keep directory sync trees that have not
+        # been synced, and maximum total size of the sync trees (in bytes)
+        self.sync_retention = "2592000"
+        self.sync_store_max_size = "10000000000"
+
+        # maximum time (in seconds) a get-data request waits for new
+        # capture data
+        self.capture_wait_max = "30"
+
+        # default limits for serial and power-measurement captures
+        # capture_ring_size is in bytes (with optional K, M or G suffix),
+        # and capture_ring_time is in seconds.  "0" means no limit.
+        # These can also be set per-resource, and per-capture.
+        self.capture_ring_size = "0"
+        self.capture_ring_time = "0"
+
+        # format for stopped power-measurement captures: "npy" (binary,
+        # requires the numpy module) or "csv" (keep the captured text)
+        self.power_capture_format = "npy"
+
+        # time (in seconds) between entries in the index of a capture
+        # (used for time-range queries).  "0" records only the start time.
+        self.capture_index_interval = "1"
+
         # #### this is the end of the defaults section ####
         # settings after this will not be overridden by the config file
 
@@ -377,6 +467,10 @@ class req_class:
         self.api_path = ""
         self.obj_path = ""
         self.user = None
+        self.is_cgi = False
+        # a streamed (binary) response body, if any
+        self.stream = None
+        self.stream_headers = []
 
     def set_page_name(self, page_name):
         page_name = re.sub(" ","_",page_name)
@@ -540,17 +634,55 @@ th, td {
         self.html.append("Content-type: text/plain\n\n")
         self.html.append(json_data)
 
+    # send binary data directly to the client, bypassing req.html
+    # body is either a bytes object, or an iterable that yields bytes
+    # objects (e.g. a generator, for streaming long-running output)
+    # headers is a list of (name, value) tuples, for extra headers
+    def send_stream_response(self, body,
+            content_type="text/plain; charset=utf-8", headers=[]):
+        if isinstance(body, bytes):
+            body = [body]
+        self.stream_headers = [("Content-type", content_type)] + headers
+        self.stream = body
+
+    # return the response for this request, as a tuple of
+    # (status, headers, body), where headers is a list of (name, value)
+    # tuples and body is an iterable of bytes objects
+    def get_response(self):
+        if self.stream is not None:
+            return ("200 OK", self.stream_headers, self.stream)
+
+        # req.html is in CGI format: header lines, an empty line,
+        # then the body.  Each item is a line, as output by print()
+        text = "".join([line + "\n" for line in self.html])
+        head, sep, body = text.partition("\n\n")
+
+        status = "200 OK"
+        headers = []
+        for line in head.splitlines():
+            name, colon, value = line.partition(":")
+            if not colon:
+                # not a header block - send everything as the body
+                headers = []
+                body = text
+                break
+            if name.strip().lower() == "status":
+                status = value.strip()
+            else:
+                headers.append((name.strip(), value.strip()))
+
+        if not headers:
+            headers = [("Content-type", "text/html")]
+
+        return (status, headers, [body.encode("utf-8")])
+
     def get_user(self):
         return self.user.name
 
     def set_user(self):
         # look up the user using the authorization token and set req.user
-
-        # FIXTHIS (low) - should have a reverse index from auth-token to user name
-        # to speed this up.  For now a linear scan of file contents is OK.
         self.user = user_class()
 
-
         # There are two ways to set the token, one via the AUTH_TYPE and
         # HTTP_AUTHORIZATION, and the other via HTTP_COOKIE
         # either is valid
@@ -569,8 +701,6 @@ th, td {
             if auth_type != "token":
                 auth_token=""
 
-        # scan user files for matching authentication token
-
         if auth_token == "not-a-valid-token":
             log_this("Error: HTTP_AUTHORIZATOIN 'not-a-valid-token'")
             return
@@ -578,52 +708,27 @@ th, td {
         dlog_this("cookie_token=%s" % cookie_token)
         dlog_this("auth_token=%s" % auth_token)
 
-        user_dir = self.config.data_dir + "/users"
-        try:
-            user_files = os.listdir( user_dir )
-        except:
-            log_this("Error: could not read user files from " + user_dir)
+        # only check auth_token if cookie_token is not set
+        # lc never sets the cookie, only the auth_token
+        token = cookie_token or auth_token
+        if not token:
             return
 
-        found_match = False
-        for ufile in user_files:
-            upath = user_dir + "/" + ufile
-            try:
-                ufd = open(upath)
-            except:
-                log_this("Error opening upath %s" % upath)
-                continue
-
-            try:
-                udata = json.load(ufd)
-            except:
-                ufd.close()
-                log_this("Error reading json data from file %s" % upath)
-                continue
-
-            dlog_this("in get_user: udata= %s" % udata)
-            utoken = udata.get("auth_token", "not-a-valid-token")
-
-            if cookie_token:
-                if cookie_token == utoken:
-                    found_match = True
-                    break
-            elif auth_token == utoken:
-                # only check auth_token if cookie_token is not set
-                # lc never sets the cookie, only the auth_token
-                found_match = True
-                break
+        # look up the user in the token index
+        udata = token_index.lookup(self, token)
+        if not udata:
+            dlog_this("in req.set_user: no user for token")
+            return
 
-        if found_match:
-            try:
-                self.user.name = udata["name"]
-            except KeyError:
-                log_this("Error: missing 'name' field in user data file %s, in req.set_user()" % upath)
-            admin = udata.get("admin","")
-            if admin == "True":
-                self.user.admin = True
-            else:
-                self.user.admin = False
+        try:
+            self.user.name = udata["name"]
+        except KeyError:
+            log_this("Error: missing 'name' field in user data, in req.set_user()")
+        admin = udata.get("admin","")
+        if admin == "True":
+            self.user.admin = True
+        else:
+            self.user.admin = False
 
         dlog_this("in req.set_user: user=%s" % str(self.user.name))
 
@@ -1036,6 +1141,8 @@ def do_add_user(req):
 
     # save the data to the json file
     msg = save_object_data(req, "user", name, umap)
+    if not msg:
+        token_index.set_token(name, auth_token)
 
     if msg:
         log_this(msg)
@@ -1101,6 +1208,8 @@ def do_update_user(req):
 
     # save data back to json file
     msg = save_object_data(req, "user", name, umap)
+    if not msg:
+        token_index.set_token(name, umap.get("auth_token", ""))
 
     if msg:
         log_this(msg)
@@ -1158,6 +1267,8 @@ def do_remove_user(req):
         log_this("Removed file %s" % file_path)
     except OSError:
         msg = "Error: Could not remove user file for '%s'" % user
+    object_cache.invalidate("user", user)
+    token_index.remove_user(user)
 
     # Remove any reservations held by this user
     if not msg:
@@ -1560,6 +1671,7 @@ def do_remove_board(req):
         log_this("Removed file %s" % file_path)
     except OSError:
         msg = "Error: Could not remove board file for '%s'" % board
+    object_cache.invalidate("board", board)
 
     if msg:
         req.html.append(req.html_error(msg))
@@ -2014,6 +2126,8 @@ def do_remove_resource(req):
         log_this("Removed file %s" % file_path)
     except OSError:
         msg = "Error: Could not remove resource file for '%s'" % name
+    object_cache.invalidate("resource", name)
+    resource_index.invalidate()
 
     if msg:
         req.html.append(req.html_error(msg))
@@ -2127,6 +2241,10 @@ def do_put_object(req, obj_type):
     fout.write(data+'\n')
     fout.close()
 
+    object_cache.invalidate(obj_type, obj_name)
+    if obj_type == "resource":
+        resource_index.invalidate()
+
     msg += "%s accepted (filename=%s)\n" % (obj_name, filename)
 
     if obj_type == "request":
@@ -2188,6 +2306,9 @@ def do_update_object(req, obj_type):
     fout.write(data+'\n')
     fout.close()
 
+    if obj_type == "resource":
+        resource_index.invalidate()
+
     req.send_response(RSLT_OK, data)
 
 # try matching with simple wildcards (* at start or end of string)
@@ -2646,18 +2767,29 @@ def show_board_info(req, bmap):
     reservation = bmap.get("AssignedTo", "None")
     req.html.append("<li>Reservation: %s</li>" % reservation)
 
+    # get the status (from the status store, or by running the probes)
+    probes = ["network_status", "command_status"]
+    if pc:
+        probes.append("power_status")
+    status_data = get_cached_board_status(req, bmap, probes,
+            want_fresh_status(req))
+
     # show power status
     if pc:
-       (result, msg) = get_power_status(req, bmap)
-       if result == RSLT_OK:
-           power_status = msg
+       rec = get_status_record(status_data, "power_status")
+       if rec["result"] == RSLT_OK:
+           power_status = rec["status"]
        else:
-           power_status = req.html_error(msg)
+           power_status = req.html_error(rec["status"])
     else:
        power_status = "Unknown"
     req.html.append("<li>Power Status: %s</li>\n" % power_status)
-    (net_status_result, net_status_msg) = get_network_status(req, bmap)
-    (cmd_status_result, cmd_status_msg) = get_command_status(req, bmap)
+    net_rec = get_status_record(status_data, "network_status")
+    net_status_result = net_rec["result"]
+    net_status_msg = net_rec["status"]
+    cmd_rec = get_status_record(status_data, "command_status")
+    cmd_status_result = cmd_rec["result"]
+    cmd_status_msg = cmd_rec["status"]
     if net_status_result == RSLT_OK:
         network_status = net_status_msg
     else:
@@ -2750,7 +2882,7 @@ def show_object(req, obj_type, obj_name):
 
 # returns (RSLT_OK, status|RSLT_FAIL, message)
 # status can be one of: "ON", "OFF", "UNKNOWN"
-def get_power_status(req, bmap):
+def get_power_status(req, bmap, timeout=None):
     pdu_map = get_connected_resource(req, bmap, "power_controller")
     if not pdu_map:
         msg = "Board %s has no connected power_controller resource" % bmap["name"]
@@ -2764,7 +2896,7 @@ def get_power_status(req, bmap):
     cmd_str = pdu_map["status_cmd"]
     icmd_str = get_interpolated_str(cmd_str, bmap, pdu_map)
 
-    rcode, output = lc_getstatusoutput(req, icmd_str)
+    rcode, output = lc_getstatusoutput(req, icmd_str, timeout)
     if rcode:
         msg = "Result of power status operation on board %s = %d\n" % (bmap["name"], rcode)
         msg += "command output='%s'" % output
@@ -2777,7 +2909,7 @@ def get_power_status(req, bmap):
 
  # returns (RSLT_OK, status|RSLT_FAIL, message)
  # status can be one of: "RESPONSIVE", "NONRESPONSIVE", "UNKNOWN"
-def get_network_status(req, bmap):
+def get_network_status(req, bmap, timeout=None):
     # lookup command to execute in board_map
     if "network_status_cmd" not in bmap:
         msg = "board '%s' does not have network_status_cmd attribute, cannot execute" % bmap["name"]
@@ -2785,7 +2917,7 @@ def get_network_status(req, bmap):
 
     cmd_str = bmap["network_status_cmd"]
     icmd_str = get_interpolated_str(cmd_str, bmap)
-    rcode, output = lc_getstatusoutput(req, icmd_str)
+    rcode, output = lc_getstatusoutput(req, icmd_str, timeout)
     if rcode:
         msg = "Result of network status operation on board %s = %d\n" % (bmap["name"], rcode)
         msg += "command output='%s'" % output
@@ -2797,19 +2929,504 @@ def get_network_status(req, bmap):
 
  # returns (RSLT_OK, status|RSLT_FAIL, message)
  # status can be one of: "OPERATIVE", "INPORATIVE", "UNKNOWN"
-def get_command_status(req,bmap):
+def get_command_status(req, bmap, timeout=None):
     # lookup command to execute in board_map
     if "command_status_cmd" not in bmap:
         msg = "board '%s' does not have command_status_cmd attribute, cannot execute" % bmap["name"]
         return (RSLT_FAIL, msg)
     cmd_str = bmap["command_status_cmd"]
     icmd_str = get_interpolated_str(cmd_str, bmap)
-    rcode, output = lc_getstatusoutput(req, icmd_str)
+    rcode, output = lc_getstatusoutput(req, icmd_str, timeout)
     status_str = output.strip()
     if status_str not in ["OPERATIVE", "INOPERATIVE", "UNKNOWN"]:
         log_this("Invalid status_str of '%s' received from command_status_cmd" % status_str)
     return (RSLT_OK, status_str)
 
+# thread pool for running status probes, shared by all requests
+status_executor = None
+status_executor_lock = threading.Lock()
+
+def get_status_executor(req):
+    global status_executor
+
+    with status_executor_lock:
+        if not status_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            try:
+                workers = int(req.config.status_probe_workers)
+            except ValueError:
+                workers = 8
+            status_executor = ThreadPoolExecutor(max_workers=workers)
+    return status_executor
+
+status_probe_funcs = {
+    "power_status": get_power_status,
+    "network_status": get_network_status,
+    "command_status": get_command_status
+    }
+
+# run a single status probe, and time it
+# returns (result, msg, latency), where latency is in milliseconds
+def run_status_probe(req, probe, bmap, timeout):
+    start = time.monotonic()
+    try:
+        (result, msg) = status_probe_funcs[probe](req, bmap, timeout)
+    except Exception as e:
+        result = RSLT_FAIL
+        msg = "Exception running %s probe for board %s: %s" % \
+                (probe, bmap["name"], e)
+        log_this(msg)
+    latency = int((time.monotonic() - start) * 1000)
+    return (result, msg, latency)
+
+def get_status_probe_timeout(req):
+    try:
+        return float(req.config.status_probe_timeout)
+    except ValueError:
+        return 10.0
+
+# start the status probes for a board, in the status thread pool
+# returns a map of probe: future
+def submit_board_probes(req, bmap, probes, timeout):
+    executor = get_status_executor(req)
+    futures = {}
+    for probe in probes:
+        futures[probe] = executor.submit(run_status_probe, req, probe, bmap,
+                timeout)
+    return futures
+
+# collect the results of the status probes for a board, waiting
+# until deadline (a time.monotonic() value) for unfinished probes
+# returns a map of probe: (result, msg, latency)
+def collect_board_probes(bmap, futures, timeout, deadline):
+    status_map = {}
+    for probe, future in futures.items():
+        try:
+            wait_time = max(0, deadline - time.monotonic())
+            status_map[probe] = future.result(wait_time)
+        except Exception:
+            msg = "Timeout waiting for %s probe for board %s" % \
+                    (probe, bmap["name"])
+            log_this(msg)
+            status_map[probe] = (RSLT_FAIL, msg, int(timeout*1000))
+    return status_map
+
+# run the status probes for a board in parallel
+# returns a map of probe: (result, msg, latency)
+def get_board_status(req, bmap, probes=["power_status", "network_status",
+        "command_status"]):
+    timeout = get_status_probe_timeout(req)
+    futures = submit_board_probes(req, bmap, probes, timeout)
+
+    # allow some slack for process cleanup and queueing
+    deadline = time.monotonic() + timeout*2 + 5
+    return collect_board_probes(bmap, futures, timeout, deadline)
+
+# The status store holds the most recent status probe results for
+# each board, in {base_dir}/status/status-{board}.json.  It is shared
+# by all server processes, and is filled by the status poller, and by
+# any fresh status requests.
+#
+# The file has a record for each probe, like so:
+#   "power_status": { "result": "success", "status": "ON",
+#         "latency_ms": 120, "timestamp": 1700000000.0 }
+def get_status_dir(req):
+    return req.config.base_dir + "/status"
+
+def read_status_data(req, board):
+    file_path = "%s/status-%s.json" % (get_status_dir(req), board)
+    try:
+        data = object_cache.get_data("status", board, file_path)
+        return object_cache.get_map("status", board, data)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        log_this("Error reading status data for board %s" % board)
+        return {}
+
+def write_status_data(req, board, status_data):
+    status_dir = get_status_dir(req)
+    file_path = "%s/status-%s.json" % (status_dir, board)
+    json_data = json.dumps(status_data, sort_keys=True, indent=4,
+        separators=(',', ': '))
+
+    # write to a temp file and rename it, so readers never see
+    # a partially written file
+    try:
+        if not os.path.isdir(status_dir):
+            os.makedirs(status_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=status_dir, prefix=".status-")
+        with os.fdopen(fd, "w") as ofd:
+            ofd.write(json_data)
+        os.replace(tmp_path, file_path)
+        object_cache.update("status", board, file_path, json_data)
+    except OSError:
+        log_this("Error writing status data for board %s" % board)
+        object_cache.invalidate("status", board)
+
+# record the results of status probes in the status store
+# status_map is from get_board_status()
+def save_board_status(req, board, status_map):
+    status_data = read_status_data(req, board)
+    now = time.time()
+    changes = {}
+    for probe, (result, msg, latency) in status_map.items():
+        old_rec = status_data.get(probe, {})
+        if old_rec.get("status", None) != msg:
+            changes[probe] = msg
+        status_data[probe] = { "result": result, "status": msg,
+                "latency_ms": latency, "timestamp": now }
+    write_status_data(req, board, status_data)
+    if changes:
+        publish_event(req, "status", board, changes)
+    return status_data
+
+# remove cached results for some probes (e.g. after a power operation)
+def invalidate_board_status(req, board, probes):
+    status_data = read_status_data(req, board)
+    changed = False
+    for probe in probes:
+        if probe in status_data:
+            del status_data[probe]
+            changed = True
+    if changed:
+        write_status_data(req, board, status_data)
+
+# return status records for a board, from the status store if the
+# records are recent enough, otherwise by running the probes
+# returns a map of probe: { "result", "status", "latency_ms", "timestamp" }
+def get_cached_board_status(req, bmap, probes=["power_status",
+        "network_status", "command_status"], fresh=False):
+    board = bmap["name"]
+    status_data = {}
+    if not fresh:
+        try:
+            ttl = float(req.config.status_cache_ttl)
+        except ValueError:
+            ttl = 180.0
+        status_data = read_status_data(req, board)
+        now = time.time()
+        stale = []
+        for probe in probes:
+            rec = status_data.get(probe, None)
+            if not rec or now - rec.get("timestamp", 0) > ttl:
+                stale.append(probe)
+        probes = stale
+
+    if probes:
+        status_map = get_board_status(req, bmap, probes)
+        status_data = save_board_status(req, board, status_map)
+
+    return status_data
+
+# return the status record for a probe from status_data
+# The record can be missing if the probe was invalidated (by another
+# request) after the status was read, so return a placeholder for that
+def get_status_record(status_data, probe):
+    rec = status_data.get(probe, None)
+    if not rec:
+        rec = { "result": RSLT_FAIL,
+                "status": "No %s available (status was just reset)" % \
+                        probe.replace("_", " "),
+                "latency_ms": None, "timestamp": None }
+    return rec
+
+# return True if the client asked for fresh status data (with 'fresh=1')
+def want_fresh_status(req):
+    try:
+        fresh = req.form.getfirst("fresh", "0")
+    except TypeError:
+        fresh = "0"
+    return fresh in ["1", "true", "True"]
+
+# Board state changes are recorded as events, in an append-only log
+# ({base_dir}/events/events.log), with one json object per line.
+# Any server process can append to the log, and clients of
+# /api/v0.2/events follow it to receive the events as they happen.
+#
+# An event id has the form {inode}.{offset}, where offset is the
+# position of the event in the log file.  When the log exceeds
+# events_log_max_size, it is rotated (to events.log.1), and readers
+# of the old file switch to the new one.
+def get_events_log_path(req):
+    return req.config.base_dir + "/events/events.log"
+
+# record an event
+# event_type is one of: "board", "power", "status"
+# (reservation changes are published as "board" events, with the
+# changed AssignedTo, start_time and end_time fields)
+# data is a dictionary of event-specific data
+def publish_event(req, event_type, board, data):
+    import fcntl
+
+    event = { "type": event_type, "board": board, "time": time.time(),
+            "data": data }
+    line = json.dumps(event, sort_keys=True) + "\n"
+
+    log_path = get_events_log_path(req)
+    try:
+        max_size = int(req.config.events_log_max_size)
+    except ValueError:
+        max_size = 1000000
+
+    try:
+        events_dir = os.path.dirname(log_path)
+        if not os.path.isdir(events_dir):
+            os.makedirs(events_dir, exist_ok=True)
+        while True:
+            fd = open(log_path, "a")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # make sure the log was not rotated while waiting for the lock
+            try:
+                if os.fstat(fd.fileno()).st_ino == os.stat(log_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            fd.close()
+
+        with fd:
+            fd.write(line)
+            fd.flush()
+            if fd.tell() > max_size:
+                os.replace(log_path, log_path + ".1")
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    except OSError as e:
+        log_this("Error writing event to %s: %s" % (log_path, e))
+
+# publish the differences between two versions of a board's data
+def publish_board_changes(req, board, old_map, new_map):
+    changes = {}
+    for key, value in new_map.items():
+        if key != "board" and old_map.get(key, None) != value:
+            changes[key] = value
+    removed = [key for key in old_map if key not in new_map and key != "board"]
+    if changes or removed:
+        data = { "changes": changes }
+        if removed:
+            data["removed"] = removed
+        publish_event(req, "board", board, data)
+
+# generate events (in text/event-stream format) from the event log
+# starts after the event with id last_id, or at the end of the log if
+# last_id is empty.  If board is specified, only events for that board
+# are sent.
+def generate_events(req, last_id, board=None):
+    log_path = get_events_log_path(req)
+    try:
+        max_duration = float(req.config.events_max_duration)
+    except ValueError:
+        max_duration = 3600.0
+
+    # find the starting position in the log
+    fd = None
+    ino = None
+    offset = 0
+    try:
+        st = os.stat(log_path)
+        ino = st.st_ino
+        offset = st.st_size
+        if last_id:
+            id_ino, id_offset = [int(x) for x in last_id.split(".")]
+            if id_ino == ino and id_offset < st.st_size:
+                offset = id_offset
+                # skip the event the client has already seen
+                with open(log_path, "rb") as tfd:
+                    tfd.seek(offset)
+                    offset += len(tfd.readline())
+    except (OSError, ValueError):
+        pass
+
+    # tell the client how long to wait before reconnecting
+    yield b"retry: 3000\n\n"
+
+    start = time.monotonic()
+    last_send = start
+    pending = b""
+    while time.monotonic() - start < max_duration:
+        out = []
+        try:
+            st = os.stat(log_path)
+        except OSError:
+            st = None
+
+        # read any new data, including the rest of a rotated log
+        rotated = fd and st and st.st_ino != ino
+        if fd:
+            pending += fd.read()
+
+        while b"\n" in pending:
+            line, pending = pending.split(b"\n", 1)
+            event_id = "%s.%d" % (ino, offset)
+            offset += len(line) + 1
+            try:
+                event = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if board and event.get("board", None) != board:
+                continue
+            out.append(("id: %s\nevent: %s\ndata: %s\n\n" % (event_id,
+                    event["type"], json.dumps(event, sort_keys=True))).encode("utf-8"))
+
+        # (re)open the log, if it was missing or rotated
+        if rotated:
+            fd.close()
+            fd = None
+            pending = b""
+            offset = 0
+        if not fd and st:
+            try:
+                fd = open(log_path, "rb")
+                if st.st_ino != ino:
+                    ino = st.st_ino
+                    offset = 0
+                fd.seek(offset)
+            except OSError:
+                fd = None
+
+        if out:
+            yield b"".join(out)
+            last_send = time.monotonic()
+        elif time.monotonic() - last_send > 15:
+            # send a comment, to keep the connection alive
+            yield b": keepalive\n\n"
+            last_send = time.monotonic()
+
+        time.sleep(0.5)
+
+    if fd:
+        fd.close()
+
+# stream board events to the client, using Server-Sent Events
+def return_api_events(req):
+    last_id = req.environ.get("HTTP_LAST_EVENT_ID", "")
+    try:
+        if not last_id:
+            last_id = req.form.getfirst("last_event_id", "")
+        board = req.form.getfirst("board", None)
+    except TypeError:
+        board = None
+
+    headers = [("Cache-Control", "no-cache"), ("X-Accel-Buffering", "no")]
+    req.send_stream_response(generate_events(req, last_id, board),
+            "text/event-stream", headers)
+
+# poll the status of all boards in the background
+# each board is polled every status_poll_interval seconds, plus or minus
+# a random amount (up to status_poll_jitter seconds), so that the probes
+# for different boards are spread out over time
+class status_poller_class:
+    def __init__(self, config):
+        self.config = config
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_interval(self):
+        import random
+        try:
+            interval = float(self.config.status_poll_interval)
+            jitter = float(self.config.status_poll_jitter)
+        except ValueError:
+            interval = 60.0
+            jitter = 10.0
+        return max(1.0, interval + random.uniform(-jitter, jitter))
+
+    # start the status probes for a board, in the status thread pool
+    # returns (bmap, futures, timeout, deadline), or None if the board
+    # is gone
+    def start_poll(self, req, board):
+        bmap = get_object_map(req, "board", board)
+        if not bmap:
+            return None
+        timeout = get_status_probe_timeout(req)
+        futures = submit_board_probes(req, bmap, ["power_status",
+                "network_status", "command_status"], timeout)
+        # allow some slack for process cleanup and queueing
+        deadline = time.monotonic() + timeout*2 + 5
+        return (bmap, futures, timeout, deadline)
+
+    # save the results of the polls that are finished (or timed out)
+    # returns the list of boards that were finished
+    def finish_polls(self, req, polls):
+        done = []
+        now = time.monotonic()
+        for board, (bmap, futures, timeout, deadline) in polls.items():
+            if now < deadline and \
+                    not all(f.done() for f in futures.values()):
+                continue
+            done.append(board)
+            try:
+                status_map = collect_board_probes(bmap, futures, timeout,
+                        deadline)
+                save_board_status(req, board, status_map)
+            except Exception as e:
+                log_this("Error polling status for board %s: %s" % (board, e))
+        for board in done:
+            del polls[board]
+        return done
+
+    # The probes for each board are run in the status thread pool (shared
+    # with status requests), so a slow board does not hold up the
+    # polling of other boards.
+    def run(self):
+        import heapq
+        import random
+
+        log_this("Status poller started")
+        schedule = []
+        scheduled = set()
+        # polls maps board: (bmap, futures, timeout, deadline)
+        polls = {}
+        while not self.stop_event.is_set():
+            req = make_internal_req()
+
+            # schedule any new boards, spread over the first interval
+            for board in get_object_list(req, "board"):
+                if board not in scheduled:
+                    first = time.time() + random.uniform(0, self.get_interval())
+                    heapq.heappush(schedule, (first, board))
+                    scheduled.add(board)
+
+            # reschedule boards when their poll is done
+            for board in self.finish_polls(req, polls):
+                heapq.heappush(schedule,
+                        (time.time() + self.get_interval(), board))
+
+            # start polls for the boards that are due
+            while schedule and schedule[0][0] <= time.time():
+                next_time, board = heapq.heappop(schedule)
+                try:
+                    poll = self.start_poll(req, board)
+                except Exception as e:
+                    log_this("Error polling status for board %s: %s" % \
+                            (board, e))
+                    poll = None
+                if poll:
+                    polls[board] = poll
+                else:
+                    # board was removed, or could not be polled
+                    scheduled.discard(board)
+
+            # wake up periodically to look for new boards, and
+            # frequently while polls are running
+            if polls:
+                wait_time = 0.2
+            elif schedule:
+                wait_time = min(schedule[0][0] - time.time(), 10.0)
+            else:
+                wait_time = self.get_interval()
+            if wait_time > 0:
+                self.stop_event.wait(wait_time)
+
+        log_this("Status poller stopped")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="status-poller",
+                daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
 # show the web ui for boards on this machine
 def show_boards(req):
     boards = get_object_list(req, "board")
@@ -3322,21 +3939,7 @@ def get_object_list(req, obj_type):
 
 # get a list of resource of a particular type
 def get_resource_list_by_type(req, res_type):
-    data_dir = req.config.data_dir + "/resources"
-    res_list = []
-
-    filelist = os.listdir(data_dir)
-    prefix = "resource-"
-    for f in filelist:
-        if f.startswith(prefix) and f.endswith(".json"):
-            # remove board- and '.json' to get the board_name
-            name = f[len(prefix):-5]
-            rmap = get_object_map(req, "resource", name)
-            if res_type in rmap["type"]:
-                res_list.append(name)
-
-    res_list.sort()
-    return res_list
+    return resource_index.get_by_type(req, res_type)
 
 # supported api actions by path:
 # devices = list boards
@@ -3350,21 +3953,333 @@ def return_api_object_list(req, obj_type):
     obj_list = get_object_list(req, obj_type)
     req.send_api_list_response(obj_list)
 
+# return a copy of an object map (parsed json data), so that callers
+# can modify it without affecting the cached copy
+def copy_object_map(obj_map):
+    new_map = {}
+    for key, value in obj_map.items():
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        new_map[key] = value
+    return new_map
+
+# cache of object data read from json files, keyed by (obj_type, name)
+# When running as a WSGI application, the process is long-lived, and
+# this saves re-reading and re-parsing files for every request.
+# Each entry is validated against the file's stat information (mtime
+# and ctime in nanoseconds, size and inode), so changes made by other
+# processes (or by hand) are picked up on the next access.  The ctime
+# catches a same-size rewrite that keeps the old mtime (e.g. with
+# 'touch -r' or 'cp -p'), and the inode catches a file that is replaced.
+class object_cache_class:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # entries are: (obj_type, name): [stat_sig, data, obj_map]
+        # obj_map is parsed from data lazily, on first use
+        self.entries = {}
+
+    def stat_sig(self, file_path):
+        st = os.stat(file_path)
+        return (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+
+    # return the data (json text) for an object, reading it from
+    # file_path if the cached data is missing or stale
+    # raises OSError if the file can't be read
+    def get_data(self, obj_type, name, file_path):
+        key = (obj_type, name)
+        try:
+            sig = self.stat_sig(file_path)
+        except OSError:
+            self.invalidate(obj_type, name)
+            raise
+
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry and entry[0] == sig:
+            return entry[1]
+
+        # note: the stat is done before the read, so if the file changes
+        # while it is being read, the next stat will detect it
+        with open(file_path, "r") as fd:
+            data = fd.read()
+
+        with self.lock:
+            self.entries[key] = [sig, data, None]
+        return data
+
+    # return a copy of the parsed map for an object
+    # data must have been returned by get_data() - if it is the cached
+    # data, the cached parse is used
+    # raises ValueError on invalid json
+    def get_map(self, obj_type, name, data):
+        key = (obj_type, name)
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if not entry or entry[1] is not data:
+            return json.loads(data)
+
+        obj_map = entry[2]
+        if obj_map is None:
+            obj_map = json.loads(data)
+            with self.lock:
+                entry[2] = obj_map
+        return copy_object_map(obj_map)
+
+    # record data just written to file_path
+    def update(self, obj_type, name, file_path, data):
+        try:
+            sig = self.stat_sig(file_path)
+        except OSError:
+            self.invalidate(obj_type, name)
+            return
+        with self.lock:
+            self.entries[(obj_type, name)] = [sig, data, None]
+
+    def invalidate(self, obj_type, name):
+        with self.lock:
+            self.entries.pop((obj_type, name), None)
+
+object_cache = object_cache_class()
+
+# return a signature for the files in a directory, with the name and
+# stat data of each file, or None if the directory cannot be read
+def get_dir_files_sig(dir_path):
+    sig = []
+    try:
+        for entry in os.scandir(dir_path):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            sig.append((entry.name, st.st_mtime_ns, st.st_ctime_ns,
+                    st.st_ino, st.st_size))
+    except OSError:
+        return None
+    sig.sort()
+    return tuple(sig)
+
+# time (in seconds) between full checks of the files in a watched
+# directory (see dir_watch_class)
+DIR_WATCH_INTERVAL = 10
+
+# detect changes to the files in a directory, for the in-memory indexes
+# Files added, removed or renamed (including files replaced by a rename,
+# as most editors do) change the mtime of the directory, which is
+# checked on every call.  A file changed in place does not, so the stat
+# data of all the files is only compared every DIR_WATCH_INTERVAL
+# seconds.  Changes made through the server invalidate the indexes
+# directly, so they don't depend on this.
+class dir_watch_class:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dir_sig = None
+        self.files_sig = None
+        self.files_checked = 0
+
+    # return True if the files in dir_path may have changed since the
+    # last call (or if this is the first call)
+    def changed(self, dir_path):
+        try:
+            st = os.stat(dir_path)
+            dir_sig = (st.st_mtime_ns, st.st_ino)
+        except OSError:
+            dir_sig = None
+
+        now = time.monotonic()
+        with self.lock:
+            if self.files_checked and dir_sig == self.dir_sig and \
+                    now - self.files_checked < DIR_WATCH_INTERVAL:
+                return False
+
+            files_sig = get_dir_files_sig(dir_path)
+            changed = not self.files_checked or dir_sig != self.dir_sig \
+                    or files_sig != self.files_sig
+            self.dir_sig = dir_sig
+            self.files_sig = files_sig
+            self.files_checked = now
+            return changed
+
+# index from auth_token to user, used by req.set_user()
+# The index is built by scanning the user files.  Users added, updated
+# or removed through the server update the index directly (with
+# set_token() and remove_user()), and changes made to the user files by
+# hand or by another process are detected with a dir_watch_class, so a
+# lookup does not scan the directory, and a lookup of an unknown token
+# does not cause a rebuild.  User data is read through object_cache, so
+# in a long-running process a lookup does not need to open any files.
+class token_index_class:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # tokens maps auth_token to user object name (from the filename)
+        self.tokens = {}
+        self.watch = dir_watch_class()
+
+    def rebuild(self, req):
+        tokens = {}
+        try:
+            users = get_object_list(req, "user")
+        except OSError:
+            log_this("Error: could not read user files from " + \
+                    req.config.data_dir + "/users")
+            users = []
+
+        for name in users:
+            umap = get_object_map(req, "user", name)
+            utoken = umap.get("auth_token", "")
+            if utoken:
+                tokens[utoken] = name
+
+        with self.lock:
+            self.tokens = tokens
+
+    # return the user map for the user with the indicated token,
+    # or None if there is no such user
+    def lookup(self, req, token):
+        if self.watch.changed(req.config.data_dir + "/users"):
+            self.rebuild(req)
+
+        with self.lock:
+            name = self.tokens.get(token, None)
+        if not name:
+            return None
+
+        umap = get_object_map(req, "user", name)
+        if umap.get("auth_token", "") != token:
+            return None
+        return umap
+
+    # record the current token for a user
+    def set_token(self, name, token):
+        with self.lock:
+            for old_token, old_name in list(self.tokens.items()):
+                if old_name == name:
+                    del self.tokens[old_token]
+            if token:
+                self.tokens[token] = name
+
+    def remove_user(self, name):
+        self.set_token(name, None)
+
+token_index = token_index_class()
+
+# indexes of resources, by board, by (board, board_feature) and by type
+# used by find_resource() and get_resource_list_by_type()
+# The indexes are rebuilt (from object_cache) on the next lookup after
+# a resource is added, updated or removed through the server.  Changes
+# made to the resource files by hand or by another process are detected
+# with a dir_watch_class, so a lookup does not scan the directory.
+class resource_index_class:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.valid = False
+        # incremented by invalidate(), so that a rebuild that was
+        # running at the time does not mark the indexes as valid
+        self.generation = 0
+        self.watch = dir_watch_class()
+        # board: [resource names]
+        self.by_board = {}
+        # (board, board_feature): resource name
+        self.by_feature = {}
+        # type: [resource names], for resources with a list of types
+        self.by_type = {}
+        # [(resource name, type string)], for resources with a type string
+        self.str_types = []
+
+    def invalidate(self):
+        with self.lock:
+            self.valid = False
+            self.generation += 1
+
+    def rebuild(self, req):
+        with self.lock:
+            generation = self.generation
+        by_board = {}
+        by_feature = {}
+        by_type = {}
+        str_types = []
+
+        try:
+            resources = get_object_list(req, "resource")
+        except OSError:
+            log_this("Error: could not read resource files from " + \
+                    req.config.data_dir + "/resources")
+            resources = []
+
+        for name in resources:
+            rmap = get_object_map(req, "resource", name)
+            if not rmap:
+                continue
+
+            res_types = rmap.get("type", [])
+            if isinstance(res_types, list):
+                for res_type in res_types:
+                    by_type.setdefault(res_type, []).append(name)
+            else:
+                str_types.append((name, res_types))
+
+            rboard = rmap.get("board", None)
+            if not rboard:
+                continue
+            by_board.setdefault(rboard, []).append(name)
+            key = (rboard, rmap.get("board_feature", ""))
+            if key not in by_feature and "name" in rmap:
+                by_feature[key] = rmap["name"]
+
+        with self.lock:
+            self.by_board = by_board
+            self.by_feature = by_feature
+            self.by_type = by_type
+            self.str_types = str_types
+            self.valid = (generation == self.generation)
+
+    def check(self, req):
+        # check for outside changes first, so that the watch is
+        # updated before the files are read
+        changed = self.watch.changed(req.config.data_dir + "/resources")
+        if changed or not self.valid:
+            self.rebuild(req)
+
+    # return the name of the resource connected to board with the
+    # indicated board_feature, or None
+    def find(self, req, board, feature):
+        self.check(req)
+        with self.lock:
+            return self.by_feature.get((board, feature), None)
+
+    # return a list of resources connected to a board
+    def get_board_resources(self, req, board):
+        self.check(req)
+        with self.lock:
+            return list(self.by_board.get(board, []))
+
+    # return a sorted list of resources of a particular type
+    def get_by_type(self, req, res_type):
+        self.check(req)
+        with self.lock:
+            res_list = list(self.by_type.get(res_type, []))
+            # (a type string is matched by substring, as before)
+            for name, type_str in self.str_types:
+                if res_type in type_str:
+                    res_list.append(name)
+        res_list.sort()
+        return res_list
+
+resource_index = resource_index_class()
+
 # read data from json file (from data/{obj_type}s/{obj_type}-{name}.json)
 # log any errors encountered
 def get_object_data(req, obj_type, name):
     filename = obj_type + "-" + name + ".json"
     file_path = "%s/%ss/%s" %  (req.config.data_dir, obj_type, filename)
 
-    if not os.path.isfile(file_path):
+    data = ""
+    try:
+        data = object_cache.get_data(obj_type, name, file_path)
+    except FileNotFoundError:
         msg = "%s object '%s' is not recognized by the server" % (obj_type, name)
         msg += "- file_path was '%s'" % file_path
         log_this(msg)
         return {}
-
-    data = ""
-    try:
-        data = open(file_path, "r").read()
     except:
         msg = "Could not retrieve information for %s '%s'" % (obj_type, name)
         msg += "- file_path was '%s'" % file_path
@@ -3378,15 +4293,14 @@ def get_api_object_data(req, obj_type, obj_name):
     filename = obj_type + "-" + obj_name + ".json"
     file_path = "%s/%ss/%s-%s.json" %  (req.config.data_dir, obj_type, obj_type, obj_name)
 
-    if not os.path.isfile(file_path):
+    data = ""
+    try:
+        data = object_cache.get_data(obj_type, obj_name, file_path)
+    except FileNotFoundError:
         msg = "%s object '%s' in not recognized by the server" % (obj_type, obj_name)
         msg += "- file_path was '%s'" % file_path
         req.send_api_response_msg(RSLT_FAIL, msg)
         return {}
-
-    data = ""
-    try:
-        data = open(file_path, "r").read()
     except:
         msg = "Could not retrieve information for %s '%s'" % (obj_type, obj_name)
         msg += "- file_path was '%s'" % file_path
@@ -3395,6 +4309,56 @@ def get_api_object_data(req, obj_type, obj_name):
 
     return data
 
+# board fields that name connected resources
+board_resource_fields = ["power_controller", "power_measurement",
+        "serial_endpoints", "audio_endpoints", "camera"]
+
+# return the state of every board in the farm, in a single response
+# This uses the object cache, resource index and status store, and
+# does not run any status probes.  Status is null for boards that have
+# not been polled yet.
+def return_api_farm_status(req):
+    farm_data = {}
+    for board in get_object_list(req, "board"):
+        bmap = get_object_map(req, "board", board)
+        if not bmap:
+            continue
+
+        # connected resources, from the board data and the resource index
+        resources = []
+        for field in board_resource_fields:
+            value = bmap.get(field, None)
+            if not value:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            for res in value:
+                if res and res != "None" and res not in resources:
+                    resources.append(res)
+        for res in resource_index.get_board_resources(req, board):
+            if res not in resources:
+                resources.append(res)
+
+        status_data = read_status_data(req, board)
+        board_data = {
+            "AssignedTo": bmap.get("AssignedTo", "nobody"),
+            "end_time": bmap.get("end_time", "0-0-0_0:0:0"),
+            "resources": resources
+            }
+        for probe in ["power_status", "network_status", "command_status"]:
+            rec = status_data.get(probe, None)
+            if rec:
+                board_data[probe] = rec["status"]
+                board_data[probe + "_timestamp"] = rec["timestamp"]
+            else:
+                board_data[probe] = None
+                board_data[probe + "_timestamp"] = None
+
+        farm_data[board] = board_data
+
+    req.send_api_response(RSLT_OK, { "data": farm_data,
+            "timestamp": time.time() })
+
 # return the list of boards that I have reserved
 # (that are assigned to me)
 def return_my_board_list(req):
@@ -3423,7 +4387,7 @@ def get_object_map(req, obj_type, obj_name):
     if not data:
         return {}
     try:
-        obj_map = json.loads(data)
+        obj_map = object_cache.get_map(obj_type, obj_name, data)
     except:
         msg = "Invalid json detected in %s '%s'" % (obj_type, obj_name)
         msg += "\njson='%s'" % data
@@ -3455,7 +4419,7 @@ def get_api_object_map(req, obj_type, obj_name):
     if not data:
         return {}
     try:
-        obj_map = json.loads(data)
+        obj_map = object_cache.get_map(obj_type, obj_name, data)
     except:
         msg = "Invalid json detected in %s '%s'" % (obj_type, obj_name)
         msg += "\njson='%s'" % data
@@ -3482,6 +4446,13 @@ def save_object_data(req, obj_type, obj_name, obj_data):
     if obj_type == "board":
         del obj_data["board"]
 
+        # get the previous data, to publish the changes
+        try:
+            old_data = object_cache.get_data(obj_type, obj_name, file_path)
+            old_map = object_cache.get_map(obj_type, obj_name, old_data)
+        except (OSError, ValueError):
+            old_map = {}
+
     #log_this("in save_object_data: obj_data=%s" % obj_data)
 
     json_data = json.dumps(obj_data, sort_keys=True, indent=4,
@@ -3491,9 +4462,17 @@ def save_object_data(req, obj_type, obj_name, obj_data):
         ofd = open(file_path, "w")
         ofd.write(json_data)
         ofd.close()
+        object_cache.update(obj_type, obj_name, file_path, json_data)
     except:
         msg = "Error: cannot write data to file %s" % file_path
         log_this(msg)
+        object_cache.invalidate(obj_type, obj_name)
+
+    if obj_type == "resource":
+        resource_index.invalidate()
+
+    if obj_type == "board" and not msg:
+        publish_board_changes(req, obj_name, old_map, obj_data)
 
     return msg
 
@@ -3501,8 +4480,8 @@ def get_connected_resource(req, board_map, resource_type):
     # look up connected resource type in board map
     resource = board_map.get(resource_type, None)
     if not resource:
-        msg = "Could not find a %s resource connected to board '%s'" % (resource_type, board)
-        req.send_response(RSLT_FAIL, msg)
+        msg = "Could not find a %s resource connected to board '%s'" % (resource_type, board_map["name"])
+        dlog_this(msg)
         return None
 
     rmap = get_object_map(req, "resource", resource)
@@ -3520,12 +4499,19 @@ def return_api_object_data(req, obj_type, obj_name):
 
     if obj_type == "board":
         # fill in dynamic board status data
-        (result, msg) = get_power_status(req, data)
-        data["power_status"] = msg
-        (result, msg) = get_network_status(req, data)
-        data["network_status"] = msg
-        (result, msg) = get_command_status(req, data)
-        data["command_status"] = msg
+        # (cached data is used, unless the caller specified 'fresh=1')
+        probes = ["power_status", "network_status", "command_status"]
+        status_data = get_cached_board_status(req, data, probes,
+                want_fresh_status(req))
+        latency_map = {}
+        timestamp_map = {}
+        for probe in probes:
+            rec = get_status_record(status_data, probe)
+            data[probe] = rec["status"]
+            latency_map[probe] = rec["latency_ms"]
+            timestamp_map[probe] = rec["timestamp"]
+        data["status_latency_ms"] = latency_map
+        data["status_timestamp"] = timestamp_map
 
     req.send_api_response(RSLT_OK, data)
 
@@ -3741,13 +4727,12 @@ def do_status_operation(req, board, board_map, rest):
         item = ""
 
     if item:
-        if item == "power":
-            (result, msg) = get_power_status(req, board_map)
-        elif item == "network":
-            (result, msg) = get_network_status(req, board_map)
-        elif item == "command":
-            (result, msg) = get_command_status(req, board_map)
-        req.send_api_response_msg(result,msg)
+        # use the cached status, unless the caller specified 'fresh=1'
+        probe = item + "_status"
+        status_data = get_cached_board_status(req, board_map, [probe],
+                want_fresh_status(req))
+        rec = get_status_record(status_data, probe)
+        req.send_api_response_msg(rec["result"], rec["status"])
     else:
         msg = "bare status operation is not supported"
         req.send_api_response_msg(RSLT_FAIL, msg)
@@ -3781,7 +4766,12 @@ def do_board_power_operation(req, board, board_map, rest):
             req.send_api_response_msg(result, msg)
             return
     elif action in ["on", "off", "reboot"]:
-        return_exec_command(req, board_map, pdu_map, action)
+        (result, msg) = exec_command(req, board_map, pdu_map, action)
+        req.send_api_response_msg(result, msg)
+        publish_event(req, "power", board, { "action": action,
+                "result": result })
+        # the cached power status is now out of date
+        invalidate_board_status(req, board, ["power_status"])
         return
     else:
         msg = "power action '%s' not supported" % action
@@ -3825,6 +4815,7 @@ def clear_reservation(req, board_map):
     board = board_map["name"]
 
     # save data back to json file
+    # (this publishes a board event with the reservation changes)
     msg = save_object_data(req, "board", board, board_map)
 
     # terminate web terminal process, if any (ignore any errors)
@@ -3939,34 +4930,42 @@ def do_board_release(req, board, board_map, rest):
     req.send_api_response_msg(RSLT_OK, msg)
     return
 
-def do_board_run(req, board, board_map, rest):
-    # check board permission
-    if not user_has_board_reserved(req, board_map, "run"):
-        return
-
-    # get the command to run
+# get the command to run from the request, and return the board's
+# run_cmd, interpolated with it
+# returns (command_to_run, cmd_str, msg) - msg is non-empty on error
+def get_run_cmd_str(req, board, board_map):
     try:
         run_data = req.form.value.decode("utf-8")
         dlog_this("run_data=%s" % run_data)
         command_to_run = json.loads(run_data).get("command", "")
-    except (TypeError, AttributeError):
+    except (TypeError, AttributeError, ValueError):
         command_to_run = req.form.getfirst("command", "")
 
     dlog_this("command_to_run=%s" % command_to_run)
     if not command_to_run:
         msg = "Cannot parse 'command' from form data (or it was empty)"
-        req.send_api_response_msg(RSLT_FAIL, msg)
-        return
+        return (None, None, msg)
 
     cmd_str = board_map.get("run_cmd", None)
 
     if not cmd_str:
         msg = "Device '%s' is not configured to run commands" % board
-        req.send_api_response_msg(RSLT_FAIL, msg)
-        return
+        return (command_to_run, None, msg)
 
     run_map = { "command": command_to_run }
     cmd_str = get_interpolated_str(cmd_str, board_map, run_map)
+    return (command_to_run, cmd_str, "")
+
+def do_board_run(req, board, board_map, rest):
+    # check board permission
+    if not user_has_board_reserved(req, board_map, "run"):
+        return
+
+    # get the command to run
+    command_to_run, cmd_str, msg = get_run_cmd_str(req, board, board_map)
+    if msg:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
     log_this("About to run_command '%s' on board %s" % (cmd_str, board_map["name"]))
 
@@ -3986,154 +4985,563 @@ def do_board_run(req, board, board_map, rest):
     req.send_api_response(RSLT_OK, { "data": data } )
     return
 
-# this is experimental code for a better 'run' operation
-# stream the data back the client, interleaving stdout and stderr
-# also encode the final rcode in the stream
-# markers are:
+# Jobs are commands run on a board in the background.  The client
+# starts a job, and then polls for its output, in pieces, until the job
+# is finished.  This avoids holding a connection open for the whole
+# duration of a long-running command.
 #
-# marker_err = b"&now^for#std%err"
-# marker_out = b"&now^for#std%out"
-# marker_rcode = b"&now^for#rcode%"
-# rcode marker must be followed by an exactly 3-character string representing
-# the return code of the executed process (0-255)
+# Each job has a directory ({base_dir}/jobs/{job_id}) with:
+#   job.json - job data (board, user, command, start time)
+#   stdout, stderr - the output of the command
+#   rcode - the return code of the command (written when it finishes)
+#   runner_pid - the pid of the process running the job
+#
+# The command is run by a separate, detached process
+# ('lcserver.py --run-job {job_dir}'), so the job continues after the
+# request that started it has finished.  If that process dies without
+# writing the rcode (e.g. it is killed, or the host reboots), the job
+# is marked as failed when it is next checked.
+
+# maximum amount of output returned by a single job output request
+JOB_OUTPUT_MAX_BYTES = 1024*1024
+
+# maximum time a job command can run, in seconds
+JOB_MAX_RUN_TIME = 60*60*24
+
+# return code recorded for a job whose runner process died
+JOB_RUNNER_DIED_RCODE = -1
+
+def get_jobs_dir(req):
+    return req.config.base_dir + "/jobs"
+
+# write the rcode for a job - this marks the job as done
+def write_job_rcode(job_dir, rcode):
+    with open(job_dir + "/rcode.tmp", "w") as fd:
+        fd.write(str(rcode))
+    os.replace(job_dir + "/rcode.tmp", job_dir + "/rcode")
+
+# mark a job as failed if it has no rcode, and its runner process is
+# gone (or it has been running for much longer than the runner allows)
+# returns True if the job was marked as failed
+def check_job_runner(job_dir):
+    if os.path.exists(job_dir + "/rcode"):
+        return False
 
-def do_board_run2(req, board, board_map, rest):
-    # check that user has board reserved
-    user = req.get_user()
-    assigned_to = board_map.get("AssignedTo", "nobody")
+    try:
+        with open(job_dir + "/runner_pid") as fd:
+            runner_alive = process_is_running(int(fd.read()))
+    except (OSError, ValueError):
+        # the runner may not have been recorded yet
+        runner_alive = True
 
-    # FIXTHIS - need to add authentication token to run2 request from lc
-    dlog_this("TRB: user=%s" % user)
+    try:
+        age = time.time() - os.path.getmtime(job_dir + "/job.json")
+    except OSError:
+        return False
+    if runner_alive and age <= JOB_MAX_RUN_TIME + 60*60:
+        return False
 
-    # FIXTHIS - remove this check for now
-    #if user != assigned_to:
-    #    msg = "Device is not assigned to you. It is assigned to '%s'.\nCannot run command." % assigned_to
-    #    req.send_api_response_msg(RSLT_FAIL, msg)
-    #    return
+    # the runner may have finished just now
+    if os.path.exists(job_dir + "/rcode"):
+        return False
 
-    # This seems optimistic - maybe add some error handling here
-    run_data = req.form.value.decode("utf-8")
-    dlog_this("run_data=%s" % run_data)
+    log_this("Job runner for %s died, marking job as failed" % job_dir)
     try:
-        command_to_run = json.loads(run_data).get("command", "")
-    except TypeError:
-        command_to_run = req.form.getfirst("command", "")
+        with open(job_dir + "/stderr", "a") as err_fd:
+            err_fd.write("Error: job was interrupted (job runner process exited)\n")
+        write_job_rcode(job_dir, JOB_RUNNER_DIED_RCODE)
+    except OSError:
+        return False
+    return True
 
-    dlog_this("command_to_run=%s" % command_to_run)
-    if not command_to_run:
-        msg = "Cannot parse 'command' from form data (or it was empty)"
-        req.send_api_response_msg(RSLT_FAIL, msg)
-        return
+# remove job directories for jobs that finished more than
+# job_retention seconds ago
+def prune_jobs(req):
+    import shutil
 
-    cmd_str = board_map.get("run_cmd", None)
+    try:
+        retention = float(req.config.job_retention)
+    except ValueError:
+        retention = 24*60*60
 
-    if not cmd_str:
-        msg = "Device '%s' is not configured to run commands" % board
+    jobs_dir = get_jobs_dir(req)
+    now = time.time()
+    for job_id in os.listdir(jobs_dir):
+        job_dir = jobs_dir + "/" + job_id
+        check_job_runner(job_dir)
+        try:
+            if now - os.path.getmtime(job_dir + "/rcode") > retention:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except OSError:
+            pass
+
+def do_board_start_job(req, board, board_map):
+    # check board permission
+    if not user_has_board_reserved(req, board_map, "run job"):
+        return
+
+    command_to_run, cmd_str, msg = get_run_cmd_str(req, board, board_map)
+    if msg:
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    run_map = { "command": command_to_run }
-    cmd_str = get_interpolated_str(cmd_str, board_map, run_map)
+    jobs_dir = get_jobs_dir(req)
+    try:
+        os.makedirs(jobs_dir, exist_ok=True)
+        prune_jobs(req)
+    except OSError:
+        msg = "Cannot create jobs directory %s" % jobs_dir
+        log_this(msg)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    log_this("About to run_command '%s' on board %s" % (cmd_str, board_map["name"]))
+    job_id = uuid.uuid4().hex
+    job_dir = jobs_dir + "/" + job_id
+    job_data = { "id": job_id, "board": board, "user": req.get_user(),
+            "command": command_to_run, "cmd_str": cmd_str,
+            "start_time": get_timestamp() }
 
-    # HERE is where things diverge from do_board_run()
-    #rcode, output, msg = run_command(req, cmd_str)
-    from subprocess import Popen, PIPE, STDOUT
+    log_this("Starting job %s: '%s' on board %s" % (job_id, cmd_str, board))
+    try:
+        os.mkdir(job_dir)
+        with open(job_dir + "/job.json", "w") as fd:
+            json.dump(job_data, fd, sort_keys=True, indent=4)
+
+        # run the job in a detached process
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                "--run-job", job_dir], stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                close_fds=True, start_new_session=True)
+        with open(job_dir + "/runner_pid", "w") as fd:
+            fd.write(str(proc.pid))
+    except OSError as e:
+        msg = "Cannot start job for command '%s': %s" % (cmd_str, e)
+        log_this(msg)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    exec_args = shlex.split(cmd_str)
+    req.send_api_response(RSLT_OK, { "data": { "job_id": job_id } })
 
-    marker_err = b"&now^for#std%err"
-    marker_out = b"&now^for#std%out"
-    marker_rcode = b"&now^for#rcode%"
+# run a job (in the detached job process), and record its return code
+def run_job(job_dir):
+    with open(job_dir + "/job.json") as fd:
+        job_data = json.load(fd)
 
-    output = ""
+    cmd_str = job_data["cmd_str"]
+    try:
+        exec_args = shlex.split(cmd_str)
+        with open(job_dir + "/stdout", "wb") as out_fd, \
+                open(job_dir + "/stderr", "wb") as err_fd:
+            proc = subprocess.Popen(exec_args, stdin=subprocess.DEVNULL,
+                    stdout=out_fd, stderr=err_fd, close_fds=True)
+            with open(job_dir + "/pid", "w") as fd:
+                fd.write(str(proc.pid))
+
+            # don't allow command to run for more than 24 hours
+            try:
+                rcode = proc.wait(JOB_MAX_RUN_TIME)
+            except subprocess.TimeoutExpired:
+                run_timeout(proc)
+                rcode = proc.wait()
+    except (OSError, ValueError) as e:
+        with open(job_dir + "/stderr", "a") as err_fd:
+            err_fd.write("Error: cannot run command '%s': %s\n" % (cmd_str, e))
+        rcode = 127
+
+    # write the rcode last - this marks the job as done
+    write_job_rcode(job_dir, rcode)
+
+# return the length of the longest prefix of data that does not end
+# in the middle of a utf-8 character
+def utf8_complete_len(data):
+    length = len(data)
+    # look back at most 3 bytes for the start of a multi-byte character
+    for i in range(1, min(4, length+1)):
+        byte = data[length-i]
+        if byte & 0xC0 == 0x80:
+            # continuation byte
+            continue
+        if byte & 0x80 == 0:
+            # ascii
+            return length
+        # start byte - check if the character is complete
+        if byte & 0xE0 == 0xC0:
+            needed = 2
+        elif byte & 0xF0 == 0xE0:
+            needed = 3
+        else:
+            needed = 4
+        if i >= needed:
+            return length
+        return length - i
+    return length
+
+# read output from a job file, starting at offset
+# returns (data, next_offset)
+def read_job_output(file_path, offset, max_bytes, final):
+    try:
+        with open(file_path, "rb") as fd:
+            fd.seek(offset)
+            data = fd.read(max_bytes)
+    except FileNotFoundError:
+        return ("", offset)
+
+    # don't split a utf-8 character, unless this is the end of the data
+    if not final or len(data) == max_bytes:
+        data = data[:utf8_complete_len(data)]
+    return (data.decode("utf-8", errors="replace"), offset + len(data))
+
+# return job state and output, starting at 'offset' for stdout and
+# 'err_offset' for stderr
+def return_api_job(req, job_id, rest):
+    job_dir = get_jobs_dir(req) + "/" + job_id
+    try:
+        if not re.match("^[0-9a-f]+$", job_id):
+            raise ValueError
+        with open(job_dir + "/job.json") as fd:
+            job_data = json.load(fd)
+    except (OSError, ValueError):
+        msg = "Job '%s' not found" % job_id
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    # FIXTHIS - add more stuff here
+    user = req.get_user()
+    if user != job_data["user"] and not req.user.admin:
+        msg = "Job '%s' was not started by you." % job_id
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
     try:
-        proc = Popen(exec_args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, bufsize=1)
-    except subprocess.CalledProcessError as e:
-        msg = "Can't run command '%s' in exec_command" % cmd
-        req.send_api_response_msg(RSLT_FAIL, msg)
-    except OSError as error:
-        msg = error + " trying to execute command '%s'" % cmd
+        offset = int(req.form.getfirst("offset", "0"))
+        err_offset = int(req.form.getfirst("err_offset", "0"))
+    except (ValueError, TypeError):
+        msg = "Invalid offset for job output"
         req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    # don't allow command to run for more than 24 hours
-    timer = threading.Timer(60.0*60.0*24, run_timeout, [proc])
-    timer.start()
+    # read the rcode before the output, so that no output is missed
+    # when the job finishes during this request
+    check_job_runner(job_dir)
+    try:
+        with open(job_dir + "/rcode") as fd:
+            rcode = int(fd.read())
+        state = "done"
+    except (OSError, ValueError):
+        rcode = None
+        state = "running"
+
+    final = (state == "done")
+    stdout, offset = read_job_output(job_dir + "/stdout", offset,
+            JOB_OUTPUT_MAX_BYTES, final)
+    stderr, err_offset = read_job_output(job_dir + "/stderr", err_offset,
+            JOB_OUTPUT_MAX_BYTES, final)
+
+    data = { "job_id": job_id, "board": job_data["board"],
+            "command": job_data["command"],
+            "start_time": job_data["start_time"],
+            "state": state, "return_code": rcode,
+            "stdout": stdout, "offset": offset,
+            "stderr": stderr, "err_offset": err_offset }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# return a list of job ids for a board
+def return_api_board_jobs(req, board):
+    jobs_dir = get_jobs_dir(req)
+    job_list = []
+    try:
+        job_ids = os.listdir(jobs_dir)
+    except OSError:
+        job_ids = []
+    for job_id in job_ids:
+        try:
+            with open(jobs_dir + "/" + job_id + "/job.json") as fd:
+                job_data = json.load(fd)
+        except (OSError, ValueError):
+            continue
+        if job_data["board"] == board:
+            job_list.append(job_id)
 
-    pid = proc.pid
+    req.send_api_list_response(sorted(job_list))
 
-    # Binary data needs to be sent directly
-    sys.stdout.write("Content-type: text/plain; charset=utf-8\n\n")
+# this is experimental code for a better 'run' operation
+# stream the data back the client, interleaving stdout and stderr
+# also encode the final rcode in the stream
+# markers are:
+#
+# marker_err = b"&now^for#std%err"
+# marker_out = b"&now^for#std%out"
+# marker_rcode = b"&now^for#rcode%"
+# rcode marker must be followed by an exactly 3-character string representing
+# the return code of the executed process (0-255)
 
-    # FIXTHIS - read stdout and stderr from proc, and send as we get it
+RUN2_MARKER_ERR = b"&now^for#std%err"
+RUN2_MARKER_OUT = b"&now^for#std%out"
+RUN2_MARKER_RCODE = b"&now^for#rcode%"
+
+# The framed run2 protocol (protocol=2) is used if the client asks for
+# it.  The stream starts with a magic string, including the protocol
+# version, followed by frames of:
+#   channel (1 byte), payload length (varint), payload
+# channels are: 1 = stdout, 2 = stderr, 0 = end
+# The payload of the end frame is a json object with the return code
+# and resource usage of the command.
+# See docs/NOTES-run2-protocol.txt
+RUN2_FRAME_MAGIC = b"LCRUN\x02"
+RUN2_CHANNEL_END = 0
+RUN2_CHANNEL_STDOUT = 1
+RUN2_CHANNEL_STDERR = 2
+
+# encode an integer as a varint (7 bits per byte, least significant
+# bits first, high bit set on all but the last byte)
+def encode_varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def encode_frame(channel, payload):
+    return bytes([channel]) + encode_varint(len(payload)) + payload
+
+# generate the run2 output stream for a running process
+# stdout and stderr data are sent as they are read from the process.
+# With the marker protocol (framed=False), a marker is inserted each time
+# the stream switches between them.  The stream starts out as stdout.
+def generate_run2_output(proc, timer, framed=False):
+    import selectors
+
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ, RUN2_CHANNEL_STDOUT)
+    sel.register(proc.stderr, selectors.EVENT_READ, RUN2_CHANNEL_STDERR)
+    markers = { RUN2_CHANNEL_STDOUT: RUN2_MARKER_OUT,
+            RUN2_CHANNEL_STDERR: RUN2_MARKER_ERR }
+
+    if framed:
+        yield RUN2_FRAME_MAGIC
+
+    current = RUN2_CHANNEL_STDOUT
+    rusage = None
     try:
-        output, errs = proc.communicate()
-    except:
-        proc.kill()
-        output, errs = proc.communicate()
+        while sel.get_map():
+            for key, mask in sel.select():
+                data = os.read(key.fileobj.fileno(), 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                if framed:
+                    data = encode_frame(key.data, data)
+                elif key.data != current:
+                    data = markers[key.data] + data
+                    current = key.data
+                yield data
+
+        # use wait4, to get the resource usage of the command
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        rcode = proc.returncode
+    finally:
+        # if the client went away, don't leave the process running
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        timer.cancel()
+        sel.close()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    # a process killed by a signal has a negative returncode
+    # report it like the shell does
+    if rcode < 0:
+        rcode = 128 - rcode
+    rcode = min(rcode, 255)
+    log_this("run2 rcode=%d" % rcode)
+
+    if framed:
+        end_data = { "rcode": rcode,
+            "rusage": { "utime": rusage.ru_utime, "stime": rusage.ru_stime,
+                "maxrss": rusage.ru_maxrss } }
+        yield encode_frame(RUN2_CHANNEL_END,
+                json.dumps(end_data, sort_keys=True).encode("utf-8"))
+    else:
+        yield RUN2_MARKER_RCODE + ("%03d" % rcode).encode("utf-8")
 
-    timer.cancel()
+def do_board_run2(req, board, board_map, rest):
+    # check that user has board reserved
+    if not user_has_board_reserved(req, board_map, "run"):
+        return
 
-    # should check req.is_cgi here.  this will need to be different for wsgi
-    # FIXTHIS - send back test data
-    sys.stdout.write("Here is some test data\n")
-    sys.stdout.write("this should be stdout\n")
-    sys.stdout.write(marker_err + "   EEEE - this should be stderr\n")
-    sys.stdout.write(marker_out + "more stdout data\n")
-    sys.stdout.write(marker_err + "   EEEE - more stderr data\n")
-    sys.stdout.write(marker_out + "last line of data\n")
-    sys.stdout.flush()
+    command_to_run, cmd_str, msg = get_run_cmd_str(req, board, board_map)
+    if msg:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
 
-    rcode = proc.returncode
+    # check the output protocol requested by the client
+    # (1 = markers, 2 = frames)
+    try:
+        protocol = req.form.getfirst("protocol", "1")
+    except TypeError:
+        protocol = "1"
+    if protocol not in ["1", "2"]:
+        msg = "Unsupported run2 protocol '%s'" % protocol
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    log_this("About to run_command '%s' on board %s" % (cmd_str, board_map["name"]))
 
-    # send the data back here
-    rcode_str = "%03d" % rcode
-    log_this("rcode_str='%s'" % rcode_str)
-    sys.stdout.write(marker_rcode+rcode_str)
-    sys.stdout.flush()
-    sys.exit(0)
-
-# Notes parses the binary data into a dictionary
-# all parts of the data are decoded using 'utf-8' into python str types,
-# with the file data, which is left as binary
-def parse_multipart(data):
-    boundary = data[:256].split(b"\r\n")[0]
+    # HERE is where things diverge from do_board_run()
+    from subprocess import Popen, PIPE, DEVNULL
+
+    try:
+        exec_args = shlex.split(cmd_str)
+        proc = Popen(exec_args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                close_fds=True, bufsize=0)
+    except (OSError, ValueError) as error:
+        msg = "%s trying to execute command '%s'" % (error, cmd_str)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # don't allow command to run for more than 24 hours
+    timer = threading.Timer(60.0*60.0*24, run_timeout, [proc])
+    timer.start()
+
+    # stream the output back to the client, as it is produced
+    # (using the framed protocol, if the client supports it)
+    framed = (protocol == "2")
+    if framed:
+        content_type = "application/octet-stream"
+    else:
+        content_type = "text/plain; charset=utf-8"
+    req.send_stream_response(generate_run2_output(proc, timer, framed),
+            content_type)
+
+# parse multipart form data from a stream, without reading it all
+# into memory.  fp is read in chunks, up to length bytes (or to the
+# end of the stream, if length is -1).
+# File parts are written directly to a file in stage_dir (named with
+# the basename of the part's filename).  Other parts are decoded using
+# 'utf-8' into python str types.
+# Returns a dictionary with the form fields.  For the file part,
+# "filename" is the original filename, "file_path" is the path of
+# the staged file, and "file_sha256" is the sha256 hash of the data.
+# The boundary is taken from the first line of the data, since lc
+# sends multipart data with a forced Content-type of application/json.
+def parse_multipart_stream(fp, length, stage_dir, chunk_size=65536):
+    remaining = [length]
+
+    def read_chunk():
+        size = chunk_size
+        if remaining[0] >= 0:
+            size = min(size, remaining[0])
+            if not size:
+                return b""
+        data = fp.read(size)
+        if remaining[0] >= 0:
+            remaining[0] -= len(data)
+        return data
+
+    # get the boundary from the first line
+    buf = b""
+    while b"\r\n" not in buf and len(buf) < 1024:
+        chunk = read_chunk()
+        if not chunk:
+            break
+        buf += chunk
+    boundary = buf.split(b"\r\n")[0]
     #dlog_this("boundary='%s'" % boundary)
     if not boundary.startswith(b"--"):
         return {}
 
+    delim = b"\r\n" + boundary
+    buf = buf[len(boundary):]
     data_dict = {}
-    section_list = data.split(boundary)
-    #dlog_this("section_list=%s" % section_list)
-    for section in section_list:
-        #dlog_this("section='%s'" % section)
-        if not section or section == b"--\r\n":
-            continue
-        if not section.startswith(b"\r\nContent-Disposition: form-data;"):
-            log_this("unrecognized section in form data: '%s'" % section.decode("utf-8"))
-            continue
-        key = section.split(b"name=")[1].split(b";")[0].split(b'\r')[0].replace(b'"',b'').decode("utf-8")
+    while True:
+        # after a boundary, there is either "--" (end of data), or
+        # "\r\n" and the headers for the next part
+        while len(buf) < 2:
+            chunk = read_chunk()
+            if not chunk:
+                break
+            buf += chunk
+        if not buf.startswith(b"\r\n"):
+            break
+
+        while b"\r\n\r\n" not in buf:
+            chunk = read_chunk()
+            if not chunk or len(buf) > 16384:
+                log_this("unrecognized syntax in form data headers: '%s'" % buf[:256])
+                return data_dict
+            buf += chunk
+        headers, buf = buf[2:].split(b"\r\n\r\n", 1)
+        headers = headers.decode("utf-8", errors="replace")
+
+        disposition = ""
+        for line in headers.split("\r\n"):
+            if line.lower().startswith("content-disposition:"):
+                disposition = line
+        if not disposition:
+            log_this("unrecognized section in form data: '%s'" % headers)
+
+        key = ""
+        filename = None
+        m = re.search('[; ]name="?([^";]*)"?', disposition)
+        if m:
+            key = m.group(1)
+        m = re.search('filename="?([^";]*)"?', disposition)
+        if m:
+            filename = m.group(1)
         #dlog_this("key=%s" % key)
-        try:
-            val_parts = section.split(b"\r\n")[3:-1]
-        except IndexError:
-            log_this("unrecognized syntax in form data: '%s'" % section.decode("utf-8"))
-            continue
-        #dlog_this("val_parts=%s" % val_parts)
-        value = b"\r\n".join(val_parts)
-        #dlog_this("value='%s'" % value)
-        if key=="file":
-            data_dict[key] = value
+
+        # file data goes directly to the staged file
+        if filename is not None:
+            staged_path = stage_dir + "/" + (os.path.basename(filename) or "upload-data")
+            sink = open(staged_path, "wb")
+            file_hash = hashlib.sha256()
+            data_dict["filename"] = filename
+            data_dict["file_path"] = staged_path
+        else:
+            sink = None
+            value = bytearray()
+
+        # copy the part data, up to the next boundary
+        found = False
+        while True:
+            pos = buf.find(delim)
+            if pos >= 0:
+                part_data = buf[:pos]
+                buf = buf[pos+len(delim):]
+                found = True
+            else:
+                # keep enough data to detect a boundary split across reads
+                keep = len(delim) - 1
+                part_data = buf[:-keep]
+                buf = buf[-keep:]
+
+            if sink:
+                sink.write(part_data)
+                file_hash.update(part_data)
+            elif len(value) < 1024*1024:
+                value += part_data
+
+            if found:
+                break
+            chunk = read_chunk()
+            if not chunk:
+                log_this("missing boundary at end of form data")
+                break
+            buf += chunk
+
+        if sink:
+            sink.close()
+            data_dict["file_sha256"] = file_hash.hexdigest()
         else:
             data_dict[key] = value.decode("utf-8")
 
-        if key=="file":
-            filename = section.split(b"filename=")[1].split(b";")[0].split(b'\r')[0].replace(b'"',b'').decode("utf-8")
-            data_dict["filename"] = filename
+        if not found:
+            break
 
     return data_dict
 
@@ -4147,55 +5555,486 @@ def parse_multipart(data):
 # This code assumes that the upload_cmd (in the board JSON file)
 # can handle individual files as well as recursive directory copies
 # from the host to the target.
-def do_board_upload(req, board, bmap, rest):
-    # check that user has board reserved
-    if not user_has_board_reserved(req, bmap, "upload"):
+# The blob store is a cache of uploaded files, named by the sha256
+# hash of their contents ({base_dir}/blobs/{sha256}).  lc can ask if
+# the server already has a file, and skip sending it.  The least
+# recently used blobs are removed when the total size of the store
+# exceeds blob_store_max_size.
+def get_blob_dir(req):
+    return req.config.base_dir + "/blobs"
+
+def get_blob_path(req, sha256):
+    if not re.match("^[0-9a-f]{64}$", sha256):
+        return None
+    return get_blob_dir(req) + "/" + sha256
+
+# return the path of a blob, or None if it is not in the store
+# marks the blob as recently used
+def find_blob(req, sha256):
+    blob_path = get_blob_path(req, sha256)
+    if not blob_path:
+        return None
+    try:
+        os.utime(blob_path)
+    except OSError:
+        return None
+    return blob_path
+
+# copy a file into the blob store
+# If move is True, the file is moved into the store instead (if
+# possible).  The file is not linked into the store, as the caller may
+# change the file (e.g. its permissions) after it is added.
+# returns True if the blob is in the store
+def add_blob(req, sha256, file_path, move=False):
+    import shutil
+
+    blob_path = get_blob_path(req, sha256)
+    if not blob_path:
+        return False
+    if os.path.exists(blob_path):
+        return True
+    blob_dir = get_blob_dir(req)
+    try:
+        os.makedirs(blob_dir, exist_ok=True)
+        tmp_path = "%s/.tmp-%s" % (blob_dir, uuid.uuid4().hex)
+        moved = False
+        if move:
+            try:
+                os.replace(file_path, tmp_path)
+                moved = True
+            except OSError:
+                pass
+        if not moved:
+            shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, blob_path)
+        os.utime(blob_path)
+    except OSError as e:
+        log_this("Error adding blob %s: %s" % (sha256, e))
+        return False
+    prune_blobs(req, sha256)
+    return True
+
+# remove least recently used blobs, until the store is under its
+# maximum size.  The blob named by 'keep' (just added) is not removed.
+def prune_blobs(req, keep=None):
+    try:
+        max_size = int(req.config.blob_store_max_size)
+    except ValueError:
+        max_size = 1000000000
+
+    blob_dir = get_blob_dir(req)
+    blobs = []
+    total = 0
+    for name in os.listdir(blob_dir):
+        try:
+            st = os.stat(blob_dir + "/" + name)
+        except OSError:
+            continue
+        blobs.append((st.st_mtime, st.st_size, name))
+        total += st.st_size
+
+    blobs.sort()
+    for mtime, size, name in blobs:
+        if total <= max_size:
+            break
+        if name == keep:
+            continue
+        try:
+            os.remove(blob_dir + "/" + name)
+            total -= size
+            dlog_this("Removed blob %s" % name)
+        except OSError:
+            pass
+
+# return whether the server has a blob with the indicated hash
+def return_api_blob(req, sha256):
+    if not get_blob_path(req, sha256):
+        msg = "Invalid sha256 hash '%s'" % sha256
+        req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    # get data for the upload
-    bin_form_data = req.form.value
-    form_is_from_client = True
-    if b"Content-Disposition:" in bin_form_data:
-        form_dict = parse_multipart(bin_form_data)
-    else:
-        form_is_from_client = False
-        form_dict = req.form
-
-    if form_is_from_client:
-        dest_path = form_dict["path"]
-        filename = os.path.basename(form_dict["filename"])
-        data = form_dict["file"]
-        extract = form_dict.get("extract", "false")
-        perms = form_dict.get("permissions", None)
-    else:
-        dest_path = form_dict["path"].value
-        file_item = form_dict["file"]
-        # this prints out the full file contents, uncomment for more debug data
-        #dlog_this("file_item='%s'" % (str(file_item)))
-        filename = file_item.filename
-        data = file_item.file.read()
-        extract = "false"
-        perms = None
-
-    dlog_this("dest_path=%s" % dest_path)
-    dlog_this("filename=%s" % filename)
-    # this is usually too long to show, but uncomment this for extra debug data
-    #dlog_this("data='%s'" % data)
-    dlog_this("extract=%s" % extract)
-    dlog_this("perms=%s" % perms)
+    blob_path = find_blob(req, sha256)
+    data = { "sha256": sha256, "present": bool(blob_path) }
+    if blob_path:
+        data["size"] = os.path.getsize(blob_path)
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# Resumable (chunked) uploads
+# A large file can be sent in pieces, using an upload session:
+#  - POST api/v0.2/upload-sessions (json: size, sha256, chunk_size)
+#    creates a session (or returns the existing session for the same
+#    user and file, to resume an interrupted upload)
+#  - PUT api/v0.2/upload-sessions/{id}/chunks/{n}?sha256={chunk_sha256}
+#    sends chunk n (as application/octet-stream)
+#  - GET api/v0.2/upload-sessions/{id} shows which chunks are missing
+#  - POST api/v0.2/upload-sessions/{id}/commit checks the file, and
+#    moves it into the blob store
+#  - DELETE api/v0.2/upload-sessions/{id} discards the session
+# Chunks are written directly to their offset in the session's data
+# file, so the file does not need to be assembled afterwards.  Once the
+# file is in the blob store, it is uploaded to a board by sha256 (see
+# get_upload_data).
+#
+# Sessions are stored in {base_dir}/upload-sessions/{id}, with files:
+#  session.json, data, and chunks/{n} (a marker for each chunk received)
 
-    # make sure board supports upload operation
-    cmd_str = bmap.get("upload_cmd", None)
-    if not cmd_str:
-        msg = "Device '%s' is not configured with upload_cmd" % board
+UPLOAD_CHUNK_MIN_SIZE = 64*1024
+UPLOAD_CHUNK_MAX_SIZE = 64*1024*1024
+
+def get_upload_sessions_dir(req):
+    return req.config.base_dir + "/upload-sessions"
+
+# returns (session_data, msg), with msg non-empty on error
+def get_upload_session(req, session_id):
+    session_dir = get_upload_sessions_dir(req) + "/" + session_id
+    try:
+        if not re.match("^[0-9a-f]+$", session_id):
+            raise ValueError
+        with open(session_dir + "/session.json") as fd:
+            session = json.load(fd)
+    except (OSError, ValueError):
+        return (None, "Upload session '%s' not found" % session_id)
+
+    if session["user"] != req.get_user():
+        return (None, "Upload session '%s' was not started by you" % session_id)
+
+    session["dir"] = session_dir
+    return (session, "")
+
+# return a list of the chunk numbers that have not been received
+def get_missing_chunks(session):
+    received = set(os.listdir(session["dir"] + "/chunks"))
+    missing = []
+    for n in range(session["chunk_count"]):
+        if str(n) not in received:
+            missing.append(n)
+    return missing
+
+def get_upload_session_info(session):
+    info = {}
+    for key in ["id", "size", "sha256", "chunk_size", "chunk_count"]:
+        info[key] = session[key]
+    info["missing"] = get_missing_chunks(session)
+    return info
+
+# remove upload sessions that have not been used recently
+def prune_upload_sessions(req):
+    import shutil
+
+    try:
+        retention = int(req.config.upload_session_retention)
+    except ValueError:
+        retention = 86400
+
+    sessions_dir = get_upload_sessions_dir(req)
+    now = time.time()
+    for session_id in os.listdir(sessions_dir):
+        session_dir = sessions_dir + "/" + session_id
+        try:
+            mtime = os.path.getmtime(session_dir + "/chunks")
+        except OSError:
+            mtime = 0
+        if now - mtime > retention:
+            dlog_this("Removing old upload session %s" % session_id)
+            shutil.rmtree(session_dir, ignore_errors=True)
+
+def do_create_upload_session(req):
+    try:
+        session_data = json.loads(req.form.value.decode("utf-8"))
+        size = int(session_data["size"])
+        sha256 = session_data["sha256"]
+        chunk_size = int(session_data.get("chunk_size", 8*1024*1024))
+    except (TypeError, AttributeError, ValueError, KeyError):
+        msg = "Cannot parse 'size' and 'sha256' for upload session"
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    # read file from form data into temp file on lcserver host system
-    tmpdir = tempfile.mkdtemp()
-    staged_path=tmpdir + "/" + filename
-    with open(staged_path, "wb") as fd:
-        fd.write(data)
+    if not get_blob_path(req, sha256) or size < 0:
+        msg = "Invalid sha256 or size for upload session"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    try:
+        max_size = int(req.config.upload_session_max_size)
+        max_count = int(req.config.upload_session_max_count)
+    except ValueError:
+        max_size = 1000000000
+        max_count = 4
+    if size > max_size:
+        msg = "File is too large for upload session (%d bytes, max %d)" % \
+                (size, max_size)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    chunk_size = max(UPLOAD_CHUNK_MIN_SIZE,
+            min(chunk_size, UPLOAD_CHUNK_MAX_SIZE))
+    sessions_dir = get_upload_sessions_dir(req)
+    user = req.get_user()
+    try:
+        os.makedirs(sessions_dir, exist_ok=True)
+        prune_upload_sessions(req)
+    except OSError:
+        msg = "Cannot create upload sessions directory %s" % sessions_dir
+        log_this(msg)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # resume an existing session by this user for the same file
+    # (get_upload_session only returns sessions started by the user)
+    user_count = 0
+    for session_id in os.listdir(sessions_dir):
+        session, msg = get_upload_session(req, session_id)
+        if not session or session["user"] != user:
+            continue
+        if session["sha256"] == sha256 and session["size"] == size:
+            log_this("Resuming upload session %s" % session_id)
+            req.send_api_response(RSLT_OK,
+                    { "data": get_upload_session_info(session) })
+            return
+        user_count += 1
+
+    if user_count >= max_count:
+        msg = "Too many upload sessions for user %s (max %d)" % \
+                (user, max_count)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    session_id = uuid.uuid4().hex
+    session_dir = sessions_dir + "/" + session_id
+    session = { "id": session_id, "user": user, "size": size,
+            "sha256": sha256, "chunk_size": chunk_size,
+            "chunk_count": max(1, (size + chunk_size - 1) // chunk_size),
+            "start_time": get_timestamp() }
+    try:
+        os.makedirs(session_dir + "/chunks")
+        # make the data file full-size, so chunks can be written
+        # in any order
+        with open(session_dir + "/data", "wb") as fd:
+            fd.truncate(size)
+        with open(session_dir + "/session.json", "w") as fd:
+            json.dump(session, fd, sort_keys=True, indent=4)
+    except OSError as e:
+        msg = "Cannot create upload session: %s" % e
+        log_this(msg)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    log_this("Created upload session %s for %s (%d bytes)" % \
+            (session_id, sha256, size))
+    session["dir"] = session_dir
+    req.send_api_response(RSLT_OK,
+            { "data": get_upload_session_info(session) })
+
+# receive one chunk of an upload session
+# The chunk data is written directly into the data file, at the offset
+# for the chunk.  The chunk is marked as received only if its size and
+# sha256 hash are correct.
+def do_put_upload_chunk(req, session, chunk):
+    try:
+        n = int(chunk)
+        if n < 0 or n >= session["chunk_count"]:
+            raise ValueError
+    except ValueError:
+        msg = "Invalid chunk number '%s'" % chunk
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    chunk_sha256 = req.form.getfirst("sha256", "")
+    if not isinstance(req.form, mycgiform_class) or not chunk_sha256:
+        msg = "Chunk must be sent as application/octet-stream, with sha256"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    offset = n * session["chunk_size"]
+    chunk_len = min(session["chunk_size"], session["size"] - offset)
+    fp, length = req.form.get_stream()
+    if length != chunk_len:
+        msg = "Chunk %d has wrong size (%s, expected %d)" % \
+                (n, length, chunk_len)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    sha = hashlib.sha256()
+    fd = os.open(session["dir"] + "/data", os.O_WRONLY)
+    try:
+        pos = 0
+        while pos < chunk_len:
+            data = fp.read(min(65536, chunk_len - pos))
+            if not data:
+                break
+            os.pwrite(fd, data, offset + pos)
+            sha.update(data)
+            pos += len(data)
+    finally:
+        os.close(fd)
+
+    if pos != chunk_len or sha.hexdigest() != chunk_sha256:
+        msg = "Chunk %d is incomplete or corrupt" % n
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # mark the chunk as received
+    marker_path = "%s/chunks/%d" % (session["dir"], n)
+    open(marker_path, "w").close()
+    os.utime(session["dir"] + "/chunks")
+
+    req.send_api_response_msg(RSLT_OK, "Chunk %d received" % n)
+
+# check that all chunks are present, and that the data is correct, and
+# move the file into the blob store
+def do_commit_upload_session(req, session):
+    import shutil
+
+    missing = get_missing_chunks(session)
+    if missing:
+        msg = "Upload session is missing %d chunks" % len(missing)
+        req.send_api_response(RSLT_FAIL, { "message": msg,
+                "data": get_upload_session_info(session) })
+        return
+
+    data_path = session["dir"] + "/data"
+    sha = hashlib.sha256()
+    with open(data_path, "rb") as fd:
+        while True:
+            data = fd.read(1024*1024)
+            if not data:
+                break
+            sha.update(data)
+
+    sha256 = session["sha256"]
+    if sha.hexdigest() != sha256:
+        # the chunks were all correct, so the session is unusable
+        shutil.rmtree(session["dir"], ignore_errors=True)
+        msg = "Upload data is corrupt (sha256 mismatch)"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    if not add_blob(req, sha256, data_path, move=True):
+        msg = "Could not add uploaded file to blob store"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    shutil.rmtree(session["dir"], ignore_errors=True)
+    log_this("Committed upload session %s" % session["id"])
+    req.send_api_response(RSLT_OK, { "message": "Upload committed",
+            "data": { "sha256": sha256, "size": session["size"] } })
+
+# handle api/v0.2/upload-sessions/...
+def do_upload_session_action(req, rest):
+    import shutil
+
+    if req.get_user() == "not-logged-in":
+        req.send_api_response_msg(RSLT_FAIL, "You are not logged in.")
+        return
+
+    method = req.environ.get("REQUEST_METHOD", "GET")
+    if not rest:
+        if method != "POST":
+            msg = "Use POST to create an upload session"
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+        do_create_upload_session(req)
+        return
+
+    session, msg = get_upload_session(req, rest[0])
+    if not session:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    if len(rest) == 1:
+        if method == "DELETE":
+            shutil.rmtree(session["dir"], ignore_errors=True)
+            req.send_api_response_msg(RSLT_OK, "Upload session deleted")
+        else:
+            req.send_api_response(RSLT_OK,
+                    { "data": get_upload_session_info(session) })
+        return
+
+    if rest[1] == "chunks" and len(rest) == 3 and method == "PUT":
+        do_put_upload_chunk(req, session, rest[2])
+        return
+
+    if rest[1] == "commit" and len(rest) == 2 and method == "POST":
+        do_commit_upload_session(req, session)
+        return
+
+    msg = "Unsupported upload session operation '%s %s'" % \
+            (method, "/".join(rest[1:]))
+    req.send_api_response_msg(RSLT_FAIL, msg)
+
+# get the data for an upload from the request, and stage the file
+# in tmpdir.  The file data is streamed to the staged file, rather than
+# being read into memory.  If the client sent the sha256 hash of a file
+# in the blob store, instead of the file data, the blob is used.
+# returns (upload_map, msg), where upload_map has:
+#   dest_path, staged_path, filename, extract, perms, fields
+# (fields has all the form fields)
+# msg is non-empty on error
+def get_upload_data(req, tmpdir):
+    import shutil
+
+    if not isinstance(req.form, mycgiform_class):
+        # form data from a browser (the cgi module has already put the
+        # file data in a temporary file)
+        file_item = req.form["file"]
+        filename = os.path.basename(file_item.filename)
+        staged_path = tmpdir + "/" + filename
+        with open(staged_path, "wb") as fd:
+            shutil.copyfileobj(file_item.file, fd, 65536)
+        return ({ "dest_path": req.form["path"].value,
+                "staged_path": staged_path, "filename": filename,
+                "extract": "false", "perms": None, "fields": {} }, "")
+
+    # form data from lc
+    fp, length = req.form.get_stream()
+    form_dict = parse_multipart_stream(fp, length, tmpdir)
+    if "path" not in form_dict:
+        return (None, "Could not parse path from upload form data")
+
+    sha256 = form_dict.get("sha256", "")
+    if "file_path" in form_dict:
+        staged_path = form_dict["file_path"]
+        if sha256:
+            if sha256 != form_dict["file_sha256"]:
+                msg = "Upload data is corrupt (sha256 mismatch)"
+                return (None, msg)
+            add_blob(req, sha256, staged_path)
+    elif sha256 and "filename" in form_dict:
+        # use the copy of the file in the blob store
+        blob_path = find_blob(req, sha256)
+        if not blob_path:
+            msg = "File with sha256 %s is not on the server" % sha256
+            return (None, msg)
+        filename = os.path.basename(form_dict["filename"]) or "upload-data"
+        staged_path = tmpdir + "/" + filename
+        # a tarball is only read, so it can share the blob's inode,
+        # but a regular file may have its permissions changed
+        try:
+            if form_dict.get("extract", "false") != "true":
+                raise OSError
+            os.link(blob_path, staged_path)
+        except OSError:
+            shutil.copyfile(blob_path, staged_path)
+        dlog_this("using blob %s for upload" % sha256)
+    else:
+        return (None, "Could not parse file from upload form data")
+
+    return ({ "dest_path": form_dict["path"], "staged_path": staged_path,
+            "filename": os.path.basename(staged_path),
+            "extract": form_dict.get("extract", "false"),
+            "perms": form_dict.get("permissions", None),
+            "fields": form_dict }, "")
+
+# prepare a staged file for upload: set its permissions, or extract it
+# (if it is a tarball of a directory)
+# For a tarball, upload_map["stats"] is set to the codec, sizes,
+# compression ratio and extraction time.
+# returns (src_path, name, msg), with msg non-empty on error
+def prepare_staged_upload(tmpdir, upload_map):
+    staged_path = upload_map["staged_path"]
+    filename = upload_map["filename"]
+    extract = upload_map["extract"]
+    perms = upload_map["perms"]
 
     if extract != "true" and perms:
         # set permissions on the staged file
@@ -4203,41 +6042,575 @@ def do_board_upload(req, board, bmap, rest):
         os.chmod(staged_path, int(perms, 8))
 
     if extract == "true":
+        # get the codec from the extension
+        # (tar detects the compression format itself)
+        codec = "gzip"
+        ext = ".tar.gz"
+        for name, (content_type, codec_ext) in codec_info.items():
+            if filename.endswith(codec_ext):
+                codec = name
+                ext = codec_ext
+
         # extract the tarball into the stage directory
         tar_cmd = "tar -C %s -xf %s" % (tmpdir, staged_path)
 
+        start = time.monotonic()
         rcode, output = getstatusoutput(tar_cmd)
+        extract_time = time.monotonic() - start
         if rcode:
             msg = "Could not extract data for directory upload\n"
             msg += "tar output=%s" % output
-            req.send_api_response_msg(RSLT_FAIL, msg)
-            return
-
-        # remove .tar.gz from filename to get directory name
-        staged_path = staged_path[:-7]
-        filename = filename[:-7]
+            return (None, None, msg)
+
+        # remove the extension from filename to get directory name
+        compressed_size = os.path.getsize(staged_path)
+        staged_path = staged_path[:-len(ext)]
+        filename = filename[:-len(ext)]
+
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(staged_path):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+
+        upload_map["stats"] = { "codec": codec,
+                "compressed_size": compressed_size, "size": size,
+                "ratio": round(size / max(compressed_size, 1), 2),
+                "extract_time": round(extract_time, 3) }
+
+    return (staged_path, filename, "")
+
+# run the board's upload_cmd, to copy src_path to dest_path on the board
+# returns (result, msg)
+def run_upload_cmd(req, board, bmap, src_path, dest_path):
+    cmd_str = bmap.get("upload_cmd", None)
+    if not cmd_str:
+        msg = "Device '%s' is not configured with upload_cmd" % board
+        return (RSLT_FAIL, msg)
 
-    # do a file or directory upload
-    upload_map = { "src": staged_path, "dest": dest_path }
+    upload_map = { "src": src_path, "dest": dest_path }
     icmd_str = get_interpolated_str(cmd_str, bmap, upload_map)
 
     log_this("Executing upload command: %s" % icmd_str)
     rcode, output = lc_getstatusoutput(req, icmd_str)
+    if rcode:
+        msg = "Could not perform upload operation on board %s\n" % board
+        msg += "command output='%s'" % output
+        return (RSLT_FAIL, msg)
+
+    return (RSLT_OK, "")
+
+def do_board_upload(req, board, bmap, rest):
+    # check that user has board reserved
+    if not user_has_board_reserved(req, bmap, "upload"):
+        return
 
-    # clean up temporary files and directories
     import shutil
+
+    # make sure board supports upload operation
+    cmd_str = bmap.get("upload_cmd", None)
+    if not cmd_str:
+        msg = "Device '%s' is not configured with upload_cmd" % board
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # get data for the upload, and stage the file on the lcserver
+    # host system
+    tmpdir = tempfile.mkdtemp()
+    upload_map, msg = get_upload_data(req, tmpdir)
+    if msg:
+        shutil.rmtree(tmpdir)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    dlog_this("upload_map=%s" % upload_map)
+
+    src_path, filename, msg = prepare_staged_upload(tmpdir, upload_map)
+    if msg:
+        shutil.rmtree(tmpdir)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # do a file or directory upload
+    result, msg = run_upload_cmd(req, board, bmap, src_path,
+            upload_map["dest_path"])
+
+    # clean up temporary files and directories
     shutil.rmtree(tmpdir)
 
-    if rcode:
-        msg = "Could not perform upload operation on board %s\n" % board
-        msg += "command output='%s'" % output
+    if result != RSLT_OK:
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
     msg = "%s uploaded" % filename
-    req.send_api_response_msg(RSLT_OK, msg)
+    req.send_api_response(RSLT_OK, { "message": msg,
+            "data": upload_map.get("stats", {}) })
     return
 
+# return the list of tags for a board
+# tags can be specified in the board file as a list, or as a string
+# with tags separated by commas or spaces
+def get_board_tags(bmap):
+    tags = bmap.get("tags", [])
+    if isinstance(tags, str):
+        tags = tags.replace(",", " ").split()
+    return tags
+
+# upload a file to multiple boards
+# The file is staged (and extracted) once, and then the upload_cmd for
+# each board is run in parallel.
+# boards are specified with the 'boards' field (a comma-separated
+# list of board names), or the 'tag' field (to select all boards
+# with that tag).  These must be in the query string (or in a browser
+# form), so that the boards can be checked before the upload data
+# is read.
+# The response data has the result for each board.
+def do_multi_upload(req):
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    if req.get_user() == "not-logged-in":
+        req.send_api_response_msg(RSLT_FAIL, "You are not logged in.")
+        return
+
+    board_list = req.form.getfirst("boards", "").replace(",", " ").split()
+    tag = req.form.getfirst("tag", "")
+    if tag:
+        for board in get_object_list(req, "board"):
+            bmap = get_object_map(req, "board", board)
+            if tag in get_board_tags(bmap) and board not in board_list:
+                board_list.append(board)
+
+    if not board_list:
+        if tag:
+            msg = "No boards found with tag '%s'" % tag
+        else:
+            msg = "No boards specified for upload"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # don't read (or store) the upload data unless the user has at
+    # least one of the boards reserved
+    for board in board_list:
+        bmap = get_object_map(req, "board", board)
+        if bmap and user_has_board_reserved(req, bmap, "upload", False):
+            break
+    else:
+        msg = "None of the boards for the upload are assigned to you"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    tmpdir = tempfile.mkdtemp()
+    upload_map, msg = get_upload_data(req, tmpdir)
+    if msg:
+        shutil.rmtree(tmpdir)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    src_path, filename, msg = prepare_staged_upload(tmpdir, upload_map)
+    if msg:
+        shutil.rmtree(tmpdir)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    def upload_to_board(board):
+        start = time.monotonic()
+        bmap = get_object_map(req, "board", board)
+        if not bmap:
+            result = RSLT_FAIL
+            msg = "Could not find board '%s' registered with server" % board
+        elif not user_has_board_reserved(req, bmap, "upload", False):
+            result = RSLT_FAIL
+            msg = "Device is not assigned to you. It is assigned to '%s'." % \
+                    bmap.get("AssignedTo", "nobody")
+        else:
+            try:
+                result, msg = run_upload_cmd(req, board, bmap, src_path,
+                        upload_map["dest_path"])
+            except Exception as e:
+                result = RSLT_FAIL
+                msg = "Exception during upload to board %s: %s" % (board, e)
+                log_this(msg)
+        if result == RSLT_OK:
+            msg = "%s uploaded" % filename
+        duration = round(time.monotonic() - start, 3)
+        return { "result": result, "message": msg, "duration": duration }
+
+    try:
+        workers = int(req.config.upload_workers)
+    except ValueError:
+        workers = 8
+    try:
+        workers = min(workers, int(req.form.getfirst("max_parallel",
+                upload_map["fields"].get("max_parallel", workers))))
+    except ValueError:
+        pass
+    workers = max(1, min(workers, len(board_list)))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(zip(board_list, executor.map(upload_to_board,
+                board_list)))
+    duration = round(time.monotonic() - start, 3)
+
+    # clean up temporary files and directories
+    shutil.rmtree(tmpdir)
+
+    fail_count = 0
+    for board_result in results.values():
+        if board_result["result"] != RSLT_OK:
+            fail_count += 1
+
+    if fail_count:
+        result = RSLT_FAIL
+        msg = "Upload failed on %d of %d boards" % (fail_count,
+                len(board_list))
+    else:
+        result = RSLT_OK
+        msg = "%s uploaded to %d boards" % (filename, len(board_list))
+
+    req.send_api_response(result, { "message": msg,
+            "data": { "boards": results, "duration": duration,
+            "stats": upload_map.get("stats", {}) } })
+
+# Delta sync of directory uploads
+# The server keeps a copy of the last directory tree uploaded to each
+# board and destination, with a manifest of its entries, in:
+#  {base_dir}/sync/{board}/{key}/ (key is from the dest path and name)
+#    manifest.json - the manifest of the tree
+#    tree/{name} - the tree itself
+# The manifest has a map of relative paths to entries, like so:
+#   { "type": "file", "size": n, "sha256": "...", "mode": "644" }
+#   { "type": "dir", "mode": "755" }
+#   { "type": "link", "target": "..." }
+# lc gets the manifest (GET devices/{board}/sync?path=&name=), compares
+# it with the local tree, and sends the new manifest and the changed
+# files in a tarball (POST devices/{board}/sync).  The server updates
+# the tree, and runs upload_cmd with the tree as the source.
+# Trees that have not been synced for sync_retention seconds are
+# removed, as are the least recently synced trees when the total size
+# of the trees exceeds sync_store_max_size.
+
+def get_sync_dir(req, board, dest_path, name):
+    key = hashlib.sha256((dest_path + "\0" + name).encode("utf-8")).hexdigest()
+    return "%s/sync/%s/%s" % (req.config.base_dir, board, key[:16])
+
+# lock a sync dir (creating it if needed), and return the lock file
+# If the sync dir is removed (by prune_sync_dirs) while waiting for
+# the lock, it is created again.
+def lock_sync_dir(sync_dir, name):
+    import fcntl
+
+    while True:
+        os.makedirs(sync_dir + "/tree/" + name, exist_ok=True)
+        lock_fd = open(sync_dir + "/lock", "a")
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(sync_dir + "/lock").st_ino == \
+                    os.fstat(lock_fd.fileno()).st_ino:
+                return lock_fd
+        except OSError:
+            pass
+        lock_fd.close()
+
+# remove sync trees that have not been synced recently, then the least
+# recently synced trees, until the trees are under their maximum size.
+# The sync dir named by 'keep' (just synced) is not removed.
+def prune_sync_dirs(req, keep=None):
+    import fcntl
+    import shutil
+
+    try:
+        retention = int(req.config.sync_retention)
+        max_size = int(req.config.sync_store_max_size)
+    except ValueError:
+        retention = 2592000
+        max_size = 10000000000
+
+    sync_root = req.config.base_dir + "/sync"
+    sync_dirs = []
+    total = 0
+    for board in os.listdir(sync_root):
+        board_dir = sync_root + "/" + board
+        try:
+            keys = os.listdir(board_dir)
+        except OSError:
+            # not a board directory (e.g. a file being staged)
+            continue
+        for key in keys:
+            sync_dir = board_dir + "/" + key
+            if len(key) != 16 or not os.path.isdir(sync_dir):
+                continue
+            # use the manifest (which is written by each sync) for the
+            # time the tree was last synced, and its size
+            try:
+                mtime = os.path.getmtime(sync_dir + "/manifest.json")
+            except OSError:
+                mtime = os.path.getmtime(sync_dir)
+            size = 0
+            for entry in read_sync_manifest(sync_dir).values():
+                size += entry.get("size", 0)
+            sync_dirs.append((mtime, size, sync_dir))
+            total += size
+
+    now = time.time()
+    sync_dirs.sort()
+    for mtime, size, sync_dir in sync_dirs:
+        if now - mtime <= retention and total <= max_size:
+            break
+        if sync_dir == keep:
+            continue
+
+        # skip trees that are being synced
+        try:
+            lock_fd = open(sync_dir + "/lock", "a")
+        except OSError:
+            continue
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_fd.close()
+            continue
+        dlog_this("Removing sync tree %s" % sync_dir)
+        shutil.rmtree(sync_dir, ignore_errors=True)
+        lock_fd.close()
+        total -= size
+
+def get_manifest_hash(manifest):
+    data = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+# returns the manifest for a sync dir (empty if there is none)
+def read_sync_manifest(sync_dir):
+    try:
+        with open(sync_dir + "/manifest.json") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+def get_sync_args(req, form_dict=None):
+    if form_dict is None:
+        dest_path = req.form.getfirst("path", "")
+        name = req.form.getfirst("name", "")
+    else:
+        dest_path = form_dict.get("path", "")
+        name = form_dict.get("name", "")
+    if not dest_path or not name or "/" in name or name in [".", ".."]:
+        return (None, None, "Missing or invalid 'path' or 'name' for sync")
+    return (dest_path, name, "")
+
+def return_api_sync_manifest(req, board, bmap):
+    dest_path, name, msg = get_sync_args(req)
+    if msg:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    manifest = read_sync_manifest(get_sync_dir(req, board, dest_path, name))
+    req.send_api_response(RSLT_OK, { "data": { "entries": manifest,
+            "base": get_manifest_hash(manifest) } })
+
+# check the entries in a sync manifest
+# An entry must be a relative path (without '.' or '..' parts), and
+# must not be under a link entry, as the tree would be changed through
+# the link.
+# raises ValueError (or KeyError or TypeError) for an invalid entry
+def check_sync_manifest(manifest):
+    links = set([rel for rel, entry in manifest.items()
+            if entry["type"] == "link"])
+    for rel, entry in manifest.items():
+        parts = rel.split("/")
+        if rel.startswith("/") or "" in parts or "." in parts or \
+                ".." in parts or entry["type"] not in ["file", "dir", "link"]:
+            raise ValueError("invalid entry '%s'" % rel)
+        for i in range(1, len(parts)):
+            if "/".join(parts[:i]) in links:
+                raise ValueError("entry '%s' is under link '%s'" % \
+                        (rel, "/".join(parts[:i])))
+
+# make the tree at root match the manifest, using the files in new_dir
+# (which has only the entries that changed)
+# Entries whose parent directory resolves to a place outside of root
+# (or new_dir, for the changed files) are not touched, and are reported
+# as problems.
+# returns a list of problems (empty if the tree matches the manifest)
+def apply_sync_manifest(root, new_dir, manifest):
+    import shutil
+
+    def entry_type(path):
+        if os.path.islink(path):
+            return "link"
+        if os.path.isdir(path):
+            return "dir"
+        return "file"
+
+    def is_inside(path, top):
+        real_top = os.path.realpath(top)
+        real_dir = os.path.realpath(os.path.dirname(path))
+        return real_dir == real_top or real_dir.startswith(real_top + "/")
+
+    problems = []
+    outside = set()
+    for rel in manifest:
+        if not is_inside(root + "/" + rel, root) or \
+                not is_inside(new_dir + "/" + rel, new_dir):
+            problems.append("%s is outside of the tree" % rel)
+            outside.add(rel)
+
+    # remove entries which are not in the manifest, or which changed type
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            etype = entry_type(path)
+            if manifest.get(rel, {}).get("type") == etype:
+                continue
+            if etype == "dir":
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    # create directories, and move changed entries into place
+    # (check each path again, as an earlier entry may have changed
+    # what its parent resolves to)
+    for rel in sorted(manifest.keys()):
+        entry = manifest[rel]
+        path = root + "/" + rel
+        if rel in outside:
+            continue
+        if not is_inside(path, root):
+            problems.append("%s is outside of the tree" % rel)
+            outside.add(rel)
+            continue
+        if entry["type"] == "dir":
+            if not os.path.islink(path):
+                os.makedirs(path, exist_ok=True)
+        elif os.path.lexists(new_dir + "/" + rel):
+            os.replace(new_dir + "/" + rel, path)
+            if entry["type"] == "file":
+                os.chmod(path, int(entry.get("mode", "644"), 8))
+
+    # set directory permissions last, in case they are read-only
+    for rel, entry in manifest.items():
+        path = root + "/" + rel
+        if entry["type"] == "dir" and rel not in outside and \
+                not os.path.islink(path) and is_inside(path, root):
+            os.chmod(path, int(entry.get("mode", "755"), 8))
+
+    # check the result
+    for rel, entry in manifest.items():
+        if rel in outside:
+            continue
+        path = root + "/" + rel
+        etype = entry_type(path) if os.path.lexists(path) else None
+        if etype != entry["type"]:
+            problems.append("%s is missing" % rel)
+        elif etype == "link" and os.readlink(path) != entry.get("target"):
+            problems.append("%s has the wrong link target" % rel)
+        elif etype == "file" and os.path.getsize(path) != entry.get("size"):
+            problems.append("%s has the wrong size" % rel)
+    return problems
+
+def do_board_sync(req, board, bmap):
+    # check that user has board reserved
+    if not user_has_board_reserved(req, bmap, "upload"):
+        return
+
+    import fcntl
+    import shutil
+
+    if not isinstance(req.form, mycgiform_class):
+        msg = "Sync data must be sent by lc"
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # stage the sync tarball next to the tree, so changed files can be
+    # moved into the tree without copying them
+    sync_root = req.config.base_dir + "/sync"
+    os.makedirs(sync_root, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=sync_root)
+    fp, length = req.form.get_stream()
+    form_dict = parse_multipart_stream(fp, length, tmpdir)
+
+    dest_path, name, msg = get_sync_args(req, form_dict)
+    if not msg and "file_path" not in form_dict:
+        msg = "Could not parse sync data from upload form data"
+    if msg:
+        shutil.rmtree(tmpdir)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    new_dir = tmpdir + "/data"
+    os.mkdir(new_dir)
+    tar_cmd = "tar -C %s -xf %s" % (new_dir, form_dict["file_path"])
+    rcode, output = getstatusoutput(tar_cmd)
+    try:
+        if rcode:
+            raise ValueError("tar output=%s" % output)
+        with open(new_dir + "/manifest.json") as fd:
+            manifest = json.load(fd)
+        check_sync_manifest(manifest)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        shutil.rmtree(tmpdir)
+        msg = "Could not extract data for directory sync\n%s" % e
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    sync_dir = get_sync_dir(req, board, dest_path, name)
+    lock_fd = lock_sync_dir(sync_dir, name)
+    try:
+        old_manifest = read_sync_manifest(sync_dir)
+        if form_dict.get("base", "") != get_manifest_hash(old_manifest):
+            msg = "Tree on server changed during sync.  Please try again."
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        root = sync_dir + "/tree/" + name
+        try:
+            problems = apply_sync_manifest(root, new_dir + "/files",
+                    manifest)
+        except OSError as e:
+            problems = [str(e)]
+        if problems:
+            # force a full sync next time
+            if old_manifest:
+                os.remove(sync_dir + "/manifest.json")
+            msg = "Could not update tree for directory sync\n"
+            msg += "\n".join(problems[:10])
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+
+        with open(sync_dir + "/manifest.json.tmp", "w") as fd:
+            json.dump(manifest, fd, sort_keys=True)
+        os.replace(sync_dir + "/manifest.json.tmp",
+                sync_dir + "/manifest.json")
+
+        changed = 0
+        for rel, entry in manifest.items():
+            if old_manifest.get(rel) != entry:
+                changed += 1
+        removed = len(set(old_manifest.keys()) - set(manifest.keys()))
+
+        result, msg = run_upload_cmd(req, board, bmap, root, dest_path)
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        lock_fd.close()
+        shutil.rmtree(tmpdir)
+
+    try:
+        prune_sync_dirs(req, sync_dir)
+    except OSError as e:
+        log_this("Error pruning sync trees: %s" % e)
+
+    if result != RSLT_OK:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    msg = "%s synced (%d changed, %d removed)" % (name, changed, removed)
+    req.send_api_response(RSLT_OK, { "message": msg,
+            "data": { "changed": changed, "removed": removed } })
+
 # download operation:
 #   get data from request
 #   use "download_cmd" command to get file or directory from the board
@@ -4257,6 +6630,7 @@ def do_board_download(req, board, bmap, rest):
     # get data for the download
 
     compress = req.form.getfirst("compress", "false")
+    codec, level = select_codec(compress, get_download_codecs())
     src_path = req.form.getfirst("path", None)
     if not src_path:
         msg = "Download request is missing path\nCannot do download."
@@ -4289,51 +6663,281 @@ def do_board_download(req, board, bmap, rest):
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    # convert the staged data to a tarball
-    tar_path = tmpdir + "/" + os.path.basename(src_path) + ".tar.gz"
-    tar_cmd = "tar -C %s -czf %s %s" % (tmpdir, tar_path, src_path[1:])
-
-    dlog_this("Executing tar_cmd: %s" % tar_cmd)
-    rcode, output = getstatusoutput(tar_cmd)
-    if rcode:
+    # send the staged data as a tar stream, generated on the fly
+    # (the tar file is not written to disk, or held in memory)
+    arcname = src_path.lstrip("/")
+    try:
+        members = get_tar_members(tmpdir, arcname)
+    except OSError as e:
+        import shutil
+        shutil.rmtree(tmpdir)
         msg = "Could not create tarfile for download\n"
-        msg += "tar output=%s" % output
+        msg += "error=%s" % e
         req.send_api_response_msg(RSLT_FAIL, msg)
         return
 
-    # read file from temp area and write to output
-    with open(tar_path, "rb") as fd:
-        bin_data = fd.read()
+    # the size of an uncompressed tar stream is known in advance
+    tar_size = get_tar_stream_size(members)
+    content_type, ext = codec_info[codec]
+    headers = [("X-LC-Codec", codec_str(codec, level)),
+            ("X-LC-Uncompressed-Size", str(tar_size))]
+    stats_trailer = req.form.getfirst("stats", "0") == "1"
+    if stats_trailer:
+        headers.append(("X-LC-Stats-Trailer",
+                str(DOWNLOAD_STATS_TRAILER_SIZE)))
+    if codec == "none":
+        content_len = tar_size
+        if stats_trailer:
+            content_len += DOWNLOAD_STATS_TRAILER_SIZE
+        headers.append(("Content-Length", str(content_len)))
 
-    # write file as response
-    # Content-type: text/html; charset=utf-8
     # Content-Disposition: attachment; filename="%s" % path
-    # Vary: Accept,Cookie,Accept-Encoding
-    # Allow: GET, HEAD, OPTIONS
-    # Content-length: xxx
-    # {data}
-
-    # Binary data needs to be sent directly:
-
-    # this was using the html.append method of returning the response
-    #req.html.append("Content-type: text/plain; charset=utf-8\n")
-    ##req.html.append('Content-Disposition: attachment; filename="%s"\n' % src_path)
-    ##req.html.append("Content-Length: %d\n" % len(data))
-    #req.html.append(data)
-
-    # output the data directly
-    # should check req.is_cgi here.  this will need to be different for wsgi
-    sys.stdout.buffer.write(b"Content-type: text/plain; charset=utf-8\n\n")
-    # write data as binary data # (sys.stdout.write() sends a string)
-    sys.stdout.buffer.write(bin_data)
-    sys.stdout.flush()
-
-    # clean up staged files and directories
+    headers.append(("Content-Disposition", 'attachment; filename="%s%s"' % \
+            (os.path.basename(src_path), ext)))
+
+    req.send_stream_response(generate_tar_stream(members, codec, level,
+            cleanup_dir=tmpdir, stats_trailer=stats_trailer),
+            content_type, headers)
+
+# Compression codecs for transfers
+# A codec is specified as "{codec}" or "{codec}-{level}", where codec is
+# one of: none, gzip, xz, zstd.  A client can specify a comma-separated
+# list of codecs, in order of preference, and the server uses the first
+# one that is available.
+# map of codec to (default level, min level, max level)
+codec_levels = {
+    "gzip": (6, 1, 9),
+    "xz": (6, 0, 9),
+    "zstd": (3, 1, 19)
+    }
+
+# map of codec to (content type, tar file extension)
+codec_info = {
+    "none": ("application/x-tar", ".tar"),
+    "gzip": ("application/gzip", ".tar.gz"),
+    "xz": ("application/x-xz", ".tar.xz"),
+    "zstd": ("application/zstd", ".tar.zst")
+    }
+
+def codec_str(codec, level):
+    if codec == "none":
+        return codec
+    return "%s-%d" % (codec, level)
+
+# return the codecs the server can use to compress downloads
+# zstd requires the (optional) 'zstandard' python module
+def get_download_codecs():
+    codecs = ["none", "gzip", "xz"]
+    try:
+        import zstandard
+        codecs.append("zstd")
+    except ImportError:
+        pass
+    return codecs
+
+# return the codecs the server can extract for uploads
+# (tar uses external programs to decompress the data)
+def get_upload_codecs():
     import shutil
-    shutil.rmtree(tmpdir)
 
-    sys.exit(0)
+    codecs = ["none"]
+    for codec in ["gzip", "xz", "zstd"]:
+        if shutil.which(codec):
+            codecs.append(codec)
+    return codecs
+
+# select a codec, from a client's list of codecs
+# "true" and "false" are supported, for older clients
+# returns (codec, level)
+def select_codec(codec_list, available):
+    if codec_list == "true":
+        codec_list = "gzip"
+    if codec_list in ["", "false"]:
+        codec_list = "none"
+
+    for item in codec_list.split(","):
+        codec, sep, level = item.strip().partition("-")
+        if codec not in available:
+            continue
+        if codec == "none":
+            return (codec, 0)
+        default, min_level, max_level = codec_levels[codec]
+        try:
+            level = max(min_level, min(int(level), max_level))
+        except ValueError:
+            level = default
+        return (codec, level)
+
+    # compression was requested, but no codec was available
+    if codec_list == "none":
+        return ("none", 0)
+    return ("gzip", codec_levels["gzip"][0])
+
+# return an object with compress() and flush() methods, for a codec
+def get_compressor(codec, level):
+    if codec == "gzip":
+        import zlib
+        # wbits=31 produces gzip format
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if codec == "xz":
+        import lzma
+        return lzma.LZMACompressor(preset=level)
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return None
+
+# return the codecs supported by the server, for downloads and uploads
+def return_api_codecs(req):
+    data = { "download": get_download_codecs(),
+            "upload": get_upload_codecs() }
+    req.send_api_response(RSLT_OK, { "data": data })
+
+TAR_BLOCKSIZE = 512
+TAR_RECORDSIZE = 20 * TAR_BLOCKSIZE
+
+# return a list of (tarinfo, path) for the items in a tar archive
+# of arcname (a path relative to root_dir)
+def get_tar_members(root_dir, arcname):
+    import io
+    import tarfile
+
+    # an in-memory tarfile object is used to create tarinfo objects
+    # (including hard link detection)
+    tf = tarfile.open(fileobj=io.BytesIO(), mode="w",
+            format=tarfile.GNU_FORMAT)
+
+    top = root_dir + "/" + arcname
+    paths = [(top, arcname)]
+    if os.path.isdir(top) and not os.path.islink(top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            rel_dir = arcname + dirpath[len(top):]
+            for name in sorted(dirnames + filenames):
+                paths.append((dirpath + "/" + name, rel_dir + "/" + name))
+
+    members = []
+    for path, name in paths:
+        tarinfo = tf.gettarinfo(path, name)
+        if tarinfo:
+            members.append((tarinfo, path))
+    return members
+
+def get_tar_header(tarinfo):
+    import tarfile
+    return tarinfo.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING,
+            "surrogateescape")
+
+def tar_padding(size, blocksize=TAR_BLOCKSIZE):
+    return (blocksize - size % blocksize) % blocksize
+
+# return the size of an (uncompressed) tar stream for members
+def get_tar_stream_size(members):
+    size = 0
+    for tarinfo, path in members:
+        size += len(get_tar_header(tarinfo))
+        if tarinfo.isreg():
+            size += tarinfo.size + tar_padding(tarinfo.size)
+    size += 2 * TAR_BLOCKSIZE
+    return size + tar_padding(size, TAR_RECORDSIZE)
+
+# generate the data of an (uncompressed) tar stream for members,
+# reading file data in chunks
+def generate_tar_data(members, chunk_size=65536):
+    size = 0
+    for tarinfo, path in members:
+        header = get_tar_header(tarinfo)
+        size += len(header)
+        yield header
+        if not tarinfo.isreg():
+            continue
 
+        # send exactly tarinfo.size bytes, even if the file changed
+        remaining = tarinfo.size
+        try:
+            with open(path, "rb") as fd:
+                while remaining:
+                    data = fd.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+        except OSError as e:
+            log_this("Error reading %s for download: %s" % (path, e))
+        if remaining:
+            log_this("File %s changed size during download" % path)
+            yield bytes(remaining)
+        pad = tar_padding(tarinfo.size)
+        size += tarinfo.size + pad
+        if pad:
+            yield bytes(pad)
+
+    end = bytes(2 * TAR_BLOCKSIZE)
+    size += len(end)
+    yield end + bytes(tar_padding(size, TAR_RECORDSIZE))
+
+# generate a tar stream for members, compressed with the indicated codec
+# if cleanup_dir is specified, it is removed when the stream is done
+# The compression ratio and time are logged at the end of the stream.
+# A client can ask for the download statistics (with 'stats=1'), which
+# can only be known once the stream is finished.  They are sent after
+# the tar data, as a trailer of DOWNLOAD_STATS_TRAILER_SIZE bytes: a
+# json map (padded with spaces), followed by DOWNLOAD_STATS_MAGIC.
+# The response has an 'X-LC-Stats-Trailer' header when there is a
+# trailer, and the client must remove it before using the tar data.
+DOWNLOAD_STATS_TRAILER_SIZE = 256
+DOWNLOAD_STATS_MAGIC = b"\nLCSTATS"
+
+def get_download_stats_trailer(stats):
+    data = json.dumps(stats, sort_keys=True,
+            separators=(",", ":")).encode("utf-8")
+    pad_size = DOWNLOAD_STATS_TRAILER_SIZE - len(DOWNLOAD_STATS_MAGIC)
+    if len(data) > pad_size:
+        # should not happen - send what the client can compute itself
+        data = json.dumps({ "codec": stats["codec"],
+                "compress_time": stats["compress_time"] }).encode("utf-8")
+    return data.ljust(pad_size) + DOWNLOAD_STATS_MAGIC
+
+# generate a (compressed) tar stream for members
+# If stats_trailer is True, the statistics for the stream (codec,
+# sizes, ratio and compression time) are sent after the tar data.
+def generate_tar_stream(members, codec="none", level=0, cleanup_dir=None,
+        stats_trailer=False):
+    compressor = get_compressor(codec, level)
+    in_size = 0
+    out_size = 0
+    compress_time = 0.0
+
+    try:
+        for data in generate_tar_data(members):
+            in_size += len(data)
+            if compressor:
+                start = time.monotonic()
+                data = compressor.compress(data)
+                compress_time += time.monotonic() - start
+            if data:
+                out_size += len(data)
+                yield data
+        if compressor:
+            start = time.monotonic()
+            data = compressor.flush()
+            compress_time += time.monotonic() - start
+            out_size += len(data)
+            yield data
+        log_this("Download stream: codec %s, %d -> %d bytes " \
+                "(ratio %.2f), compress time %.3fs" % \
+                (codec_str(codec, level), in_size, out_size,
+                in_size / max(out_size, 1), compress_time))
+        if stats_trailer:
+            yield get_download_stats_trailer({
+                    "codec": codec_str(codec, level),
+                    "size": in_size, "compressed_size": out_size,
+                    "ratio": round(in_size / max(out_size, 1), 2),
+                    "compress_time": round(compress_time, 3) })
+    finally:
+        if cleanup_dir:
+            import shutil
+            shutil.rmtree(cleanup_dir, ignore_errors=True)
 
 # rest is a list of the rest of the path
 # supported actions are: get_resource, power, assign, release, run
@@ -4379,6 +6983,13 @@ def return_api_board_action(req, board, action, rest):
         do_board_run2(req, board, board_map, rest)
         return
 
+    elif action == "jobs":
+        if req.environ.get("REQUEST_METHOD", "GET") == "POST":
+            do_board_start_job(req, board, board_map)
+        else:
+            return_api_board_jobs(req, board)
+        return
+
     elif action == "upload":
         do_board_upload(req, board, board_map, rest)
         return
@@ -4387,6 +6998,13 @@ def return_api_board_action(req, board, action, rest):
         do_board_download(req, board, board_map, rest)
         return
 
+    elif action == "sync":
+        if req.environ.get("REQUEST_METHOD", "GET") == "POST":
+            do_board_sync(req, board, board_map)
+        else:
+            return_api_sync_manifest(req, board, board_map)
+        return
+
     elif action == "camera":
         do_board_camera_operation(req, board, board_map, rest)
         return
@@ -4458,7 +7076,7 @@ def run_timeout(proc):
 # return rcode, output from getstatusoutput from command
 # the difference with this command is that it supports running
 # items from the labcontrol utils directory
-def lc_getstatusoutput(req, cmd):
+def lc_getstatusoutput(req, cmd, timeout=None):
     try:
         program_name=shlex.split(cmd)[0]
     except ValueError:
@@ -4476,7 +7094,34 @@ def lc_getstatusoutput(req, cmd):
             cmd = prog_path + " " + args
 
     dlog_this("cmd in lc_getstatusoutput is: %s" % cmd)
-    return getstatusoutput(cmd)
+    if not timeout:
+        return getstatusoutput(cmd)
+
+    return getstatusoutput_timeout(cmd, timeout)
+
+# like getstatusoutput, but kill the command (and any children) if
+# it runs for longer than timeout seconds
+def getstatusoutput_timeout(cmd, timeout):
+    from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
+
+    proc = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT,
+            close_fds=True, start_new_session=True)
+    try:
+        data, errs = proc.communicate(timeout=timeout)
+    except TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.communicate()
+        msg = "command '%s' timed out after %s seconds" % (cmd, timeout)
+        log_this(msg)
+        return (124, msg)
+
+    output = data.decode("utf-8", errors="replace")
+    if output.endswith("\n"):
+        output = output[:-1]
+    return (proc.returncode, output)
 
 # run_command - run a single line command
 # returns: return_code, output, reason
@@ -4597,6 +7242,377 @@ def get_capture_filepath(req, res_type, res_map, token):
     return cdir + CAPTURE_FILENAME_FMT % (res_map["name"], token, ext)
 
 
+# Ring-buffer captures
+# A serial or power-measurement capture can be bounded in size (and
+# optionally in time).  The capture_cmd writes to a FIFO, and a ring
+# writer process ('lcserver.py --ring-writer {ring_dir}') copies the
+# data into segment files, removing the oldest segments to stay within
+# the limits.  The ring directory is the capture filename plus ".ring",
+# and has:
+#   fifo - the logfile used by capture_cmd
+#   ring.json - the ring parameters (size, time, segment_size, pid)
+#   seg-{offset} - segment files, named with the offset of their first
+#     byte in the capture data
+#   stopped - created when the capture is stopped
+# Offsets for get-data are offsets in the capture data, so they remain
+# valid as old segments are removed.
+
+RING_SEGMENT_COUNT = 8
+RING_MIN_SEGMENT_SIZE = 4096
+
+# parse a size, with an optional K, M or G suffix
+# returns the size in bytes (raises ValueError on error, including
+# for negative or infinite sizes)
+def parse_size_str(size_str):
+    size_str = str(size_str).strip().upper()
+    mult = 1
+    for suffix, value in [("K", 1024), ("M", 1024*1024),
+            ("G", 1024*1024*1024)]:
+        if size_str.endswith(suffix):
+            size_str = size_str[:-1]
+            mult = value
+    try:
+        size = int(float(size_str) * mult)
+    except OverflowError:
+        raise ValueError("size '%s' is too large" % size_str)
+    if size < 0:
+        raise ValueError("size '%s' is negative" % size_str)
+    return size
+
+# get the ring size and time for a capture
+# These come from the request ('ring_size' and 'ring_time'), or the
+# resource ('capture_ring_size' and 'capture_ring_time'), or the server
+# configuration (capture_ring_size and capture_ring_time).
+# returns (size, time, msg), with size 0 for a regular capture
+def get_capture_ring_params(req, res_type, resource_map):
+    import math
+
+    if res_type not in ["serial", "power-measurement"]:
+        return (0, 0, "")
+
+    size_str = req.form.getfirst("ring_size", None) or \
+            resource_map.get("capture_ring_size", None) or \
+            req.config.capture_ring_size
+    time_str = req.form.getfirst("ring_time", None) or \
+            resource_map.get("capture_ring_time", None) or \
+            req.config.capture_ring_time
+    try:
+        ring_size = parse_size_str(size_str)
+        ring_time = float(time_str)
+        if not math.isfinite(ring_time) or ring_time < 0:
+            raise ValueError
+    except ValueError:
+        return (0, 0, "Invalid ring size '%s' or time '%s'" % \
+                (size_str, time_str))
+    if ring_time and not ring_size:
+        # a time window needs a ring, so use a generous size limit
+        ring_size = 1024*1024*1024
+    return (ring_size, ring_time, "")
+
+def get_ring_dir(capture_file):
+    return capture_file + ".ring"
+
+# set up a ring directory, and start the ring writer
+# returns the path of the fifo for capture_cmd
+def start_ring_capture(ring_dir, ring_size, ring_time):
+    os.makedirs(ring_dir)
+    os.mkfifo(ring_dir + "/fifo")
+    segment_size = max(RING_MIN_SEGMENT_SIZE, ring_size // RING_SEGMENT_COUNT)
+    ring = { "size": ring_size, "time": ring_time,
+            "segment_size": segment_size }
+    write_ring_data(ring_dir, ring)
+
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+            "--ring-writer", ring_dir], stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            close_fds=True, start_new_session=True)
+    ring["writer_pid"] = proc.pid
+    write_ring_data(ring_dir, ring)
+    return ring_dir + "/fifo"
+
+def read_ring_data(ring_dir):
+    with open(ring_dir + "/ring.json") as fd:
+        return json.load(fd)
+
+def write_ring_data(ring_dir, ring):
+    with open(ring_dir + "/ring.json.tmp", "w") as fd:
+        json.dump(ring, fd)
+    os.replace(ring_dir + "/ring.json.tmp", ring_dir + "/ring.json")
+
+# tell the ring writer that the capture has stopped
+# (opening and closing the fifo wakes up the writer, if it is waiting
+# for capture_cmd to open the fifo)
+def stop_ring_capture(ring_dir):
+    open(ring_dir + "/stopped", "w").close()
+    try:
+        fd = os.open(ring_dir + "/fifo", os.O_WRONLY | os.O_NONBLOCK)
+        os.close(fd)
+    except OSError:
+        # the writer is not waiting
+        pass
+
+# wait for the ring writer to write the last of the capture data
+def wait_for_ring_writer(ring_dir, timeout=5):
+    try:
+        pid = read_ring_data(ring_dir).get("writer_pid", 0)
+    except (IOError, ValueError):
+        return
+    deadline = time.monotonic() + timeout
+    while pid and time.monotonic() < deadline:
+        reap_capture_process(pid)
+        if not process_is_running(pid):
+            return
+        time.sleep(0.1)
+
+# return a sorted list of (offset, path, size) for the ring segments
+def get_ring_segments(ring_dir):
+    segments = []
+    for name in os.listdir(ring_dir):
+        if not name.startswith("seg-"):
+            continue
+        try:
+            size = os.path.getsize(ring_dir + "/" + name)
+        except OSError:
+            # segment was just removed
+            continue
+        segments.append((int(name[4:]), ring_dir + "/" + name, size))
+    segments.sort()
+    return segments
+
+# remove the oldest segments, to keep the ring within its limits
+# (the newest segment is never removed)
+def prune_ring_segments(ring_dir, ring):
+    segments = get_ring_segments(ring_dir)
+    total = sum([size for offset, path, size in segments])
+    oldest_time = time.time() - ring["time"]
+    for offset, path, size in segments[:-1]:
+        if total <= ring["size"] and \
+                (not ring["time"] or os.path.getmtime(path) >= oldest_time):
+            break
+        os.remove(path)
+        total -= size
+
+# copy data from a ring capture fifo into segment files
+# This runs in a detached process, until the capture stops.
+def run_ring_writer(ring_dir):
+    ring = read_ring_data(ring_dir)
+    segment_size = ring["segment_size"]
+    # rotate segments by time, so old data can expire
+    segment_time = ring["time"] / RING_SEGMENT_COUNT
+    offset = 0
+    seg_fd = None
+    seg_len = 0
+    seg_start_time = 0
+
+    while True:
+        # capture_cmd might open and close the logfile more than once,
+        # so keep reading until the capture is stopped
+        with open(ring_dir + "/fifo", "rb", buffering=0) as fifo:
+            while True:
+                data = fifo.read(65536)
+                if not data:
+                    break
+                pos = 0
+                while pos < len(data):
+                    if not seg_fd or seg_len >= segment_size or \
+                            (segment_time and \
+                            time.time() - seg_start_time > segment_time):
+                        if seg_fd:
+                            seg_fd.close()
+                        seg_fd = open("%s/seg-%016d" % (ring_dir, offset),
+                                "wb", buffering=0)
+                        seg_len = 0
+                        seg_start_time = time.time()
+                        prune_ring_segments(ring_dir, ring)
+                    count = min(len(data) - pos, segment_size - seg_len)
+                    seg_fd.write(data[pos:pos+count])
+                    pos += count
+                    seg_len += count
+                    offset += count
+
+        if os.path.exists(ring_dir + "/stopped"):
+            break
+        pid = read_ring_data(ring_dir).get("pid", 0)
+        try:
+            if pid:
+                os.kill(pid, 0)
+        except OSError:
+            # capture process is gone
+            break
+
+    if seg_fd:
+        seg_fd.close()
+
+# return True if there is data for a capture (in a file or a ring, or
+# in binary format for a converted power-measurement capture)
+def capture_exists(capture_file):
+    return os.path.exists(capture_file) or \
+            os.path.isdir(get_ring_dir(capture_file)) or \
+            os.path.exists(get_power_npy_path(capture_file))
+
+# return (start, end) offsets of the data available for a capture
+def get_capture_extent(capture_file):
+    ring_dir = get_ring_dir(capture_file)
+    if not os.path.isdir(ring_dir):
+        return (0, os.path.getsize(capture_file))
+
+    segments = get_ring_segments(ring_dir)
+    if not segments:
+        return (0, 0)
+    offset, path, size = segments[-1]
+    return (segments[0][0], offset + size)
+
+# read up to max_bytes of capture data, starting at offset
+# If offset is before the start of a ring capture, the data starts at
+# the oldest data available.
+# returns (data, start), where start is the offset of the data
+def read_capture_range(capture_file, offset, max_bytes):
+    ring_dir = get_ring_dir(capture_file)
+    if not os.path.isdir(ring_dir):
+        with open(capture_file, "rb") as fd:
+            fd.seek(offset)
+            return (fd.read(max_bytes), offset)
+
+    data = b""
+    start = None
+    for seg_offset, path, size in get_ring_segments(ring_dir):
+        if seg_offset + size <= offset:
+            continue
+        try:
+            with open(path, "rb") as fd:
+                if offset > seg_offset:
+                    fd.seek(offset - seg_offset)
+                chunk = fd.read(max_bytes - len(data))
+        except FileNotFoundError:
+            # segment was removed by the ring writer
+            continue
+        if start is None:
+            start = max(offset, seg_offset)
+        data += chunk
+        if len(data) >= max_bytes:
+            break
+    if start is None:
+        start = offset
+    return (data, start)
+
+# A capture index records the size of the capture data over time, so
+# that time-range queries can find the data without reading the whole
+# capture.  The index file has lines of "{time} {offset}", where offset
+# is the end of the data (in bytes) captured by that time.  The first
+# line records the start of the capture.
+def get_index_path(capture_file):
+    return capture_file + ".idx"
+
+def add_index_entry(index_path, timestamp, offset):
+    with open(index_path, "a") as fd:
+        fd.write("%.6f %d\n" % (timestamp, offset))
+
+# start a capture indexer for the capture by process pid
+def start_capture_index(req, capture_file, pid, start_time):
+    index_path = get_index_path(capture_file)
+    add_index_entry(index_path, start_time, 0)
+
+    try:
+        interval = float(req.config.capture_index_interval)
+    except ValueError:
+        interval = 1.0
+    if interval <= 0:
+        return
+
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+            "--capture-index", capture_file, str(pid), str(interval)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, close_fds=True,
+            start_new_session=True)
+
+# return True if process pid is running
+# (a zombie process, that another process has not reaped, is not)
+def process_is_running(pid):
+    import psutil
+
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+# record the size of the capture data every interval seconds, until
+# the capture process exits
+# This runs in a separate process (lcserver.py --capture-index)
+def run_capture_indexer(capture_file, pid, interval):
+    index_path = get_index_path(capture_file)
+    last_offset = 0
+    while True:
+        running = process_is_running(pid)
+
+        try:
+            start, offset = get_capture_extent(capture_file)
+        except OSError:
+            # capture has not started writing, or was removed
+            offset = last_offset
+        if offset != last_offset:
+            add_index_entry(index_path, time.time(), offset)
+            last_offset = offset
+
+        if not running:
+            break
+        time.sleep(interval)
+
+# returns a list of (time, offset) entries for a capture, or an empty
+# list if the capture has no index
+def read_capture_index(capture_file):
+    index = []
+    try:
+        with open(get_index_path(capture_file)) as fd:
+            for line in fd:
+                parts = line.split()
+                if len(parts) == 2:
+                    index.append((float(parts[0]), int(parts[1])))
+    except (IOError, ValueError):
+        pass
+    return index
+
+# find the byte range of the data captured between start_time and
+# end_time, using the capture index
+# The range includes all of the data captured in the time range (and
+# possibly some data captured up to one index interval outside of it).
+# returns (start, end) offsets
+def find_index_range(index, start_time, end_time, extent):
+    import bisect
+
+    times = [entry[0] for entry in index]
+    i = bisect.bisect_right(times, start_time) - 1
+    start = index[i][1] if i >= 0 else 0
+
+    j = bisect.bisect_left(times, end_time)
+    end = index[j][1] if j < len(index) else extent[1]
+
+    # data before the start of a ring capture has been discarded
+    start = max(start, extent[0])
+    return (start, max(start, min(end, extent[1])))
+
+# parse a time for a time-range query
+# The time is one of:
+#   {seconds} - seconds relative to the start of the capture
+#   @{seconds} - absolute time, in seconds since the epoch
+#   YYYY-MM-DD HH:MM:SS[.ffffff] - absolute time, in server local time
+#     (an underscore may be used instead of the space)
+# returns time in seconds since the epoch
+def parse_capture_time(time_str, capture_start):
+    time_str = time_str.strip()
+    if time_str.startswith("@"):
+        return float(time_str[1:])
+
+    if ":" in time_str:
+        time_str = time_str.replace("_", " ")
+        for fmt in ["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"]:
+            try:
+                return datetime.datetime.strptime(time_str, fmt).timestamp()
+            except ValueError:
+                pass
+        raise ValueError("invalid time '%s'" % time_str)
+
+    return capture_start + float(time_str)
+
 # returns token, reason
 # on error, token is None or empty and reason is a string with an error
 # message.  The error message should start with "Error: "
@@ -4630,24 +7646,54 @@ def start_capture(req, res_type, resource_map, rest):
         else:
             d["duration"] = req.config.default_video_recording_duration
 
+    ring_size, ring_time, msg = get_capture_ring_params(req, res_type,
+            resource_map)
+    if msg:
+        return ("", msg)
+
     try:
         cmd = capture_cmd % d
     except KeyError as e:
         return ("", "Problem interpolating capture_cmd in resource definition of '%s', msg=KeyError: %s" % (resource, str(e)))
 
+    # for a ring-buffer capture, capture_cmd writes to a fifo instead
+    ring_dir = None
+    if ring_size:
+        ring_dir = get_ring_dir(capture_file)
+        try:
+            d["logfile"] = start_ring_capture(ring_dir, ring_size, ring_time)
+        except OSError as e:
+            return ("", "Cannot set up ring capture: %s" % e)
+        d["output"] = d["logfile"]
+        cmd = capture_cmd % d
+        log_this("ring capture: size=%d, time=%s" % (ring_size, ring_time))
+
     dlog_this("(interpolated) cmd=" + cmd)
 
     # save pid and capture filename in a file, named with the token
-    pid, msg = start_command(req, token, cmd)
+    # the output files of the command are named with the resource and
+    # token, as captures started together can have the same token
+    start_time = time.time()
+    pid, msg = start_command(req, resource + "-" + token, cmd)
     if not pid:
         log_this("exec failure: reason=" + msg)
+        if ring_dir:
+            stop_ring_capture(ring_dir)
         return ("", msg)
 
+    if ring_dir:
+        ring = read_ring_data(ring_dir)
+        ring["pid"] = pid
+        write_ring_data(ring_dir, ring)
+
     log_this("capture pid=%d" % pid)
     fd = open(pidfile,"w")
     fd.write(str(pid) + "\n" + capture_file)
     fd.close()
 
+    if res_type in ["serial", "power-measurement", "audio"]:
+        start_capture_index(req, capture_file, pid, start_time)
+
     return (token, "")
 
 # capture - capture a still image
@@ -4676,6 +7722,29 @@ def capture(req, res_type, resource_map, rest):
 
     return (url_path, "")
 
+# collect the exit status of a capture process that has exited
+# When lcserver runs as a long-lived (WSGI) process, capture processes
+# are its children, and remain as zombies (which can still be signaled)
+# until they are reaped.
+def reap_capture_process(pid):
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # not our child (e.g. started by a different CGI process)
+        pass
+
+# return True if the capture for resource and token is still running
+def capture_is_running(resource, token):
+    pidfile = CAPTURE_PID_FILENAME_FMT % (resource, token)
+    try:
+        with open(pidfile, "r") as fd:
+            pid = int(fd.read().split('\n')[0].strip())
+        reap_capture_process(pid)
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
 # returns msg with:
 #   msg = empty on success, non-empty on failure
 # msg has the stderr output, if any, of the command on failure
@@ -4714,11 +7783,13 @@ def stop_capture(req, res_type, resource_map, token, rest):
             dlog_this("Sending SIGTERM to pid %d" % pid)
             os.kill(pid, signal.SIGTERM)
             time.sleep(sigterm_retry_wait[count])
+            reap_capture_process(pid)
             count += 1
         log_this("Exceeded max sigterm retries")
         log_this("Sending SIGKILL to pid %d" % pid)
         os.kill(pid, signal.SIGKILL)
-        sleep(5)
+        time.sleep(5)
+        reap_capture_process(pid)
         os.kill(pid, signal.SIGKILL)
         log_this("SIGKILL failed - process %d is still running!!" % pid)
     except OSError as err:
@@ -4728,13 +7799,23 @@ def stop_capture(req, res_type, resource_map, token, rest):
                 dlog_this("Removing pidfile %s" % pidfile)
                 os.remove(pidfile)
 
+    capture_file = get_capture_filepath(req, res_type, resource_map, token)
+    ring_dir = get_ring_dir(capture_file)
+    if os.path.isdir(ring_dir):
+        stop_ring_capture(ring_dir)
+
+    if res_type == "power-measurement" and capture_exists(capture_file):
+        msg = start_power_conversion(req, resource_map, capture_file)
+        if msg:
+            log_this(msg)
+
     # check for program error (stderr is non-empty)
-    cout_file = "/tmp/capture-stdout-" + token
+    cout_file = "/tmp/capture-stdout-%s-%s" % (resource, token)
     if os.path.exists(cout_file):
         dlog_this("Removing capture stdout file %s" % cout_file)
         os.remove(cout_file)
 
-    cerr_file = "/tmp/capture-stderr-" + token
+    cerr_file = "/tmp/capture-stderr-%s-%s" % (resource, token)
     msg = ""
     if os.path.exists(cerr_file):
         stderr = open(cerr_file, "r").read()
@@ -4746,25 +7827,232 @@ def stop_capture(req, res_type, resource_map, token, rest):
 
     return msg
 
+# maximum amount of capture data returned by one get-data request
+CAPTURE_READ_MAX_BYTES = 1024*1024
+
+# read captured data incrementally, starting at 'offset'
+# form values are:
+#  offset - the byte offset in the capture to start reading from
+#  max_bytes - the maximum number of bytes to read
+#  wait - if there is no data after offset, wait up to this many
+#     seconds for new data (long-poll)
+#  encoding - 'utf-8' (the default) or 'base64' (for binary data)
+# returns (data, reason), where data is a map with the capture data
+# ("output"), the offset of the data ("start"), the offset to use for
+# the next read ("offset"), the current size of the capture, and
+# whether the capture is still running
+def read_captured_data(req, resource, capture_file, token):
+    try:
+        offset = int(req.form.getfirst("offset", "0"))
+        max_bytes = int(req.form.getfirst("max_bytes",
+                str(CAPTURE_READ_MAX_BYTES)))
+        wait = float(req.form.getfirst("wait", "0"))
+    except (ValueError, TypeError):
+        return (None, "Invalid offset, max_bytes or wait for get-data")
+    encoding = req.form.getfirst("encoding", "utf-8")
+
+    offset = max(0, offset)
+    max_bytes = max(1, min(max_bytes, CAPTURE_READ_MAX_BYTES))
+    try:
+        wait = min(wait, float(req.config.capture_wait_max))
+    except ValueError:
+        wait = min(wait, 30)
+
+    # long-poll: wait until there is data after offset, or the capture
+    # stops
+    # For utf-8 output, data that is only the start of a multi-byte
+    # character is not returned (until the rest of it is captured),
+    # so keep waiting in that case too.
+    deadline = time.monotonic() + wait
+    while True:
+        running = capture_is_running(resource, token)
+        start, size = get_capture_extent(capture_file)
+        if not running or time.monotonic() >= deadline:
+            break
+        if size > offset:
+            if encoding == "base64" or size - offset >= 4:
+                break
+            tail, tail_start = read_capture_range(capture_file, offset,
+                    size - offset)
+            if tail_start != offset or utf8_complete_len(tail):
+                break
+        time.sleep(0.25)
+
+    # for a ring capture, data before 'start' may have been discarded
+    data, start = read_capture_range(capture_file, offset, max_bytes)
+
+    if encoding == "base64":
+        import base64
+        output = base64.b64encode(data).decode("ascii")
+    else:
+        # don't split a utf-8 character, unless this is the end of
+        # the data
+        if running or len(data) == max_bytes:
+            data = data[:utf8_complete_len(data)]
+        output = data.decode("utf-8", errors="replace")
+
+    return ({ "output": output, "start": start, "offset": start + len(data),
+            "size": size, "running": running }, "")
+
+# encodings for Sun audio (.au) files, and their sample sizes (in bytes)
+au_sample_sizes = { 1: 1, 2: 1, 3: 2, 4: 3, 5: 4, 6: 4, 7: 8, 27: 1 }
+
+# find the byte range of an audio capture between start_time and
+# end_time, from the header of the .au file
+# returns (start, end, header), where header is the file header
+# (to put in front of the data), or None if the file is not a
+# supported .au file
+def find_audio_range(capture_file, start_time, end_time, capture_start):
+    import struct
+
+    with open(capture_file, "rb") as fd:
+        header = fd.read(24)
+        if len(header) < 24 or header[:4] != b".snd":
+            return (0, 0, None)
+        data_offset, size, encoding, rate, channels = \
+                struct.unpack(">5I", header[4:])
+        frame_size = au_sample_sizes.get(encoding, 0) * channels
+        if not frame_size or not rate:
+            return (0, 0, None)
+        fd.seek(0)
+        header = fd.read(data_offset)
+
+    # set the data size in the header to 'unknown'
+    header = header[:8] + struct.pack(">I", 0xffffffff) + header[12:]
+
+    extent = os.path.getsize(capture_file)
+    def get_offset(t):
+        frames = max(0, int((t - capture_start) * rate))
+        return min(extent, data_offset + frames * frame_size)
+    return (get_offset(start_time), get_offset(end_time), header)
+
+# returns (data, reason), where data is a map with the data captured
+# between start_str and end_str ("output"), the start time of the
+# capture ("capture_start"), and the start and end of the data in the
+# capture ("start" and "end", which are byte offsets, or sample numbers
+# for a converted power-measurement capture)
+# See parse_capture_time for the time formats.  If start_str or end_str
+# is None, the range starts at the start of the capture, or ends at the
+# end of the capture.
+# The data is encoded with the form value 'encoding' ('utf-8' or
+# 'base64').  Audio data defaults to base64, and starts with the header
+# of the audio file.
+def read_captured_range(req, res_type, resource_map, capture_file, token,
+        start_str, end_str):
+    resource = resource_map["name"]
+    index = read_capture_index(capture_file)
+
+    npy_path = get_power_npy_path(capture_file)
+    converted = res_type == "power-measurement" and \
+            not os.path.exists(capture_file) and os.path.exists(npy_path)
+    if converted:
+        import numpy as np
+        with open(get_power_meta_path(capture_file)) as fd:
+            meta = json.load(fd)
+        scale = power_unit_scales["time"][meta["units"]["time"]]
+        records = np.load(npy_path, mmap_mode="r")
+        if not len(records):
+            return (None, "No power-measurement samples in capture for resource '%s', token %s" % (resource, token))
+        if index:
+            capture_start = index[0][0]
+        else:
+            capture_start = float(records["time"][0]) * scale
+    elif index:
+        capture_start = index[0][0]
+    else:
+        return (None, "Capture for resource '%s', token %s has no time index" % (resource, token))
+
+    try:
+        start_time = parse_capture_time(start_str or "0", capture_start)
+        end_time = parse_capture_time(end_str or "@inf", capture_start)
+    except ValueError as e:
+        return (None, "Invalid start_time or end_time: %s" % e)
+
+    running = capture_is_running(resource, token)
+    encoding = req.form.getfirst("encoding", None)
+    header = b""
+    if converted:
+        # the samples are sorted by time, so use a binary search
+        # The sample times use the device time base, so map the requested
+        # times onto it, with the first sample taken at capture_start
+        times = records["time"]
+        first_time = float(times[0])
+        dev_start = (start_time - capture_start) / scale + first_time
+        dev_end = (end_time - capture_start) / scale + first_time
+        start = int(np.searchsorted(times, dev_start, "left"))
+        end = int(np.searchsorted(times, dev_end, "right"))
+        data = get_power_csv_data(capture_file, start, end).encode("utf-8")
+    else:
+        if res_type == "audio":
+            start, end, header = find_audio_range(capture_file, start_time,
+                    end_time, capture_start)
+            header = header or b""
+            encoding = encoding or "base64"
+        if not header:
+            start, end = find_index_range(index, start_time, end_time,
+                    get_capture_extent(capture_file))
+        data, start = read_capture_range(capture_file, start, end - start)
+        end = start + len(data)
+        if res_type == "power-measurement":
+            # only return whole lines of power-measurement data
+            if start > 0:
+                data = data[data.find(b"\n")+1:]
+            data = data[:data.rfind(b"\n")+1]
+
+    if encoding == "base64":
+        import base64
+        output = base64.b64encode(header + data).decode("ascii")
+    else:
+        output = data.decode("utf-8", errors="replace")
+
+    return ({ "output": output, "capture_start": capture_start,
+            "start": start, "end": end, "running": running }, "")
+
 # returns data, reason
 # data is in json-compatible format
 # data is empty on failure, and reason is a string with error message
 # otherwise, sends data from capture.  Captured data may be transformed
 # from its original format, but in all cases should be sent as json.
+# If 'offset' or 'max_bytes' is specified in the request, the data is
+# read incrementally (see read_captured_data)
+# If 'start_time' or 'end_time' is specified, only the data captured in
+# that time range is returned (see read_captured_range)
 def get_captured_data(req, res_type, resource_map, token, rest):
     resource = resource_map["name"]
 
     capture_file = get_capture_filepath(req, res_type, resource_map, token)
 
-    if not os.path.exists(capture_file):
+    if not capture_exists(capture_file):
         return (None, "Cannot find capture file for resource '%s', token %s" % (resource, token))
 
+    start_str = req.form.getfirst("start_time", None)
+    end_str = req.form.getfirst("end_time", None)
+    if start_str is not None or end_str is not None:
+        try:
+            return read_captured_range(req, res_type, resource_map,
+                    capture_file, token, start_str, end_str)
+        except IOError as e:
+            return (None, "Cannot read capture data for resource '%s', token %s: %s" % (resource, token, e))
+
+    converted = res_type == "power-measurement" and \
+            not os.path.exists(capture_file) and \
+            os.path.exists(get_power_npy_path(capture_file))
+
+    if req.form.getfirst("offset", None) is not None or \
+            req.form.getfirst("max_bytes", None) is not None:
+        if converted:
+            export_power_csv(capture_file)
+        return read_captured_data(req, resource, capture_file, token)
+
+    if converted:
+        return (get_power_csv_data(capture_file), "")
+
     try:
-        fd = open(capture_file, "rb")
-        capture_data = fd.read()
-        fd.close()
+        start, end = get_capture_extent(capture_file)
+        capture_data, start = read_capture_range(capture_file, start,
+                end - start)
     except IOError:
-        log_data = None
+        capture_data = None
 
     if not capture_data:
         return (None, "Cannot read capture data for resource '%s', token %s" % (resource, token))
@@ -4785,7 +8073,409 @@ def get_captured_data(req, res_type, resource_map, token, rest):
         jdata += "]"
         return (jdata, "")
 
-    return (capture_data, "")
+    # json can not hold raw bytes
+    return (capture_data.decode("utf-8", errors="replace"), "")
+
+# units for the columns of power-measurement data, as scale factors to
+# SI units (seconds, volts, amps)
+power_unit_scales = {
+    "time": { "s": 1.0, "ms": 1e-3, "us": 1e-6, "ns": 1e-9 },
+    "voltage": { "V": 1.0, "mV": 1e-3, "uV": 1e-6 },
+    "current": { "A": 1.0, "mA": 1e-3, "uA": 1e-6 },
+    }
+
+POWER_STATS_MAX_BUCKETS = 10000
+
+# get the units used by a power-measurement resource for its capture data
+# These come from the resource ('time_units', 'voltage_units' and
+# 'current_units').  The default is seconds, millivolts and milliamps,
+# which is what the sdb and ACME capture programs produce.
+# returns (units, msg), where units maps each column to a unit string
+def get_power_units(resource_map):
+    units = { "time": resource_map.get("time_units", "s"),
+            "voltage": resource_map.get("voltage_units", "mV"),
+            "current": resource_map.get("current_units", "mA") }
+    for column, unit in units.items():
+        if unit not in power_unit_scales[column]:
+            return (None, "Invalid %s units '%s' for resource '%s'" % \
+                    (column, unit, resource_map["name"]))
+    return (units, "")
+
+# parse power-measurement CSV data (timestamp,voltage,current lines)
+# Drop a header line, and the partial lines at the start of data from
+# a ring capture (partial_start) and at the end of a running capture.
+# returns an array with one row per sample, or None if there is no data
+def parse_power_csv(data, partial_start):
+    import numpy as np
+    import io
+
+    if partial_start or data[:1].isalpha():
+        data = data[data.find(b"\n")+1:]
+    data = data[:data.rfind(b"\n")+1]
+    if not data:
+        return None
+
+    samples = np.loadtxt(io.BytesIO(data), delimiter=",", usecols=(0, 1, 2),
+            ndmin=2, dtype=np.float64)
+    if not len(samples):
+        return None
+    return samples
+
+# power-measurement captures are converted to a binary file (in numpy
+# .npy format) when they are stopped.  The file has one fixed-width
+# record per sample, with the values in the units used by the capture
+# program.  Voltage and current are stored as float32 if that holds
+# every value exactly, and as float64 otherwise.  A json file next to
+# it has the units and sample rate, and any header line, so that the
+# CSV data can be reproduced.
+POWER_SAMPLE_DTYPE = [("time", "<f8"), ("voltage", "<f8"), ("current", "<f8")]
+
+# amount of CSV data converted at a time
+POWER_CONVERT_CHUNK_SIZE = 4*1024*1024
+
+def get_power_npy_path(capture_file):
+    return os.path.splitext(capture_file)[0] + ".npy"
+
+def get_power_meta_path(capture_file):
+    return os.path.splitext(capture_file)[0] + ".json"
+
+# start converting the CSV data for a stopped power-measurement capture
+# to binary format
+# The conversion runs in a separate process, as it can take a long time
+# for a large capture.
+# returns msg, which is empty on success (or if conversion is disabled)
+def start_power_conversion(req, resource_map, capture_file):
+    if req.config.power_capture_format != "npy":
+        return ""
+
+    try:
+        import numpy
+    except ImportError:
+        log_this("Cannot convert power capture %s: missing 'numpy' module" % capture_file)
+        return ""
+
+    units, msg = get_power_units(resource_map)
+    if msg:
+        return msg
+
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+            "--convert-power", capture_file, json.dumps(units)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, close_fds=True,
+            start_new_session=True)
+    return ""
+
+# parse the CSV data for a power-measurement capture, a chunk at a
+# time, into a temporary file (raw_path) with 3 float64 values per sample
+# Every line must have exactly 3 numeric fields, except for a header line,
+# or (for a ring capture) a partial line at the start of the data.
+# returns (count, meta), where count is the number of samples, and
+# meta has the header and leading partial line, and whether the voltage
+# and current fit in float32.  Raises ValueError if the data can not be
+# converted exactly.
+def parse_power_capture_chunks(capture_file, raw_path):
+    import numpy as np
+    import io
+
+    start, end = get_capture_extent(capture_file)
+    meta = { "header": "", "prefix": "", "voltage_f4": True,
+            "current_f4": True }
+    count = 0
+    offset = start
+    with open(raw_path, "wb") as raw:
+        while offset < end:
+            data, pos = read_capture_range(capture_file, offset,
+                    POWER_CONVERT_CHUNK_SIZE)
+            if pos != offset or not data:
+                raise ValueError("capture data changed during conversion")
+
+            if offset == start and (start > 0 or data[:1].isalpha()):
+                line_len = data.find(b"\n") + 1
+                if start > 0:
+                    meta["prefix"] = data[:line_len].decode("utf-8")
+                else:
+                    meta["header"] = data[:line_len].decode("utf-8")
+                offset += line_len
+                data = data[line_len:]
+
+            chunk_len = data.rfind(b"\n") + 1
+            if not chunk_len:
+                if data:
+                    raise ValueError("incomplete line at offset %d" % offset)
+                continue
+
+            chunk = data[:chunk_len]
+            samples = np.loadtxt(io.BytesIO(chunk), delimiter=",",
+                    comments=None, ndmin=2, dtype=np.float64)
+            if len(samples) != chunk.count(b"\n") or \
+                    (len(samples) and samples.shape[1] != 3):
+                raise ValueError("lines without 3 fields near offset %d" % \
+                        offset)
+            for col, name in [(1, "voltage_f4"), (2, "current_f4")]:
+                if meta[name] and not np.array_equal(
+                        samples[:,col].astype(np.float32), samples[:,col]):
+                    meta[name] = False
+            samples.tofile(raw)
+            count += len(samples)
+            offset += chunk_len
+    return (count, meta)
+
+# convert the CSV data for a stopped power-measurement capture to
+# binary format, and remove the CSV data (and ring, if any)
+# If the data can not be converted exactly, the CSV data is kept.
+# This runs in a separate process (lcserver.py --convert-power)
+def run_power_conversion(capture_file, units):
+    import numpy as np
+
+    ring_dir = get_ring_dir(capture_file)
+    if os.path.isdir(ring_dir):
+        wait_for_ring_writer(ring_dir)
+
+    npy_path = get_power_npy_path(capture_file)
+    raw_path = npy_path + ".raw"
+    try:
+        count, meta = parse_power_capture_chunks(capture_file, raw_path)
+    except (IOError, ValueError, UnicodeDecodeError) as e:
+        log_this("Keeping CSV data for power capture %s: %s" % \
+                (capture_file, e))
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        return
+
+    dtype = [("time", "<f8"),
+            ("voltage", "<f4" if meta["voltage_f4"] else "<f8"),
+            ("current", "<f4" if meta["current_f4"] else "<f8")]
+    if count:
+        raw = np.memmap(raw_path, dtype="<f8", mode="r", shape=(count, 3))
+        records = np.lib.format.open_memmap(npy_path + ".tmp", mode="w+",
+                dtype=dtype, shape=(count,))
+        for i in range(0, count, 1024*1024):
+            block = raw[i:i+1024*1024]
+            records["time"][i:i+len(block)] = block[:,0]
+            records["voltage"][i:i+len(block)] = block[:,1]
+            records["current"][i:i+len(block)] = block[:,2]
+        records.flush()
+        duration = float(raw[-1,0] - raw[0,0]) * \
+                power_unit_scales["time"][units["time"]]
+        del records, raw
+    else:
+        np.save(npy_path + ".tmp", np.empty(0, dtype=dtype))
+        os.rename(npy_path + ".tmp.npy", npy_path + ".tmp")
+        duration = 0
+    os.remove(raw_path)
+
+    sample_rate = 0
+    if duration > 0:
+        sample_rate = (count - 1) / duration
+    meta = { "columns": ["time", "voltage", "current"], "units": units,
+            "samples": count, "duration": duration,
+            "sample_rate": sample_rate, "header": meta["header"],
+            "prefix": meta["prefix"] }
+
+    # the capture may have been deleted during the conversion
+    if not capture_exists(capture_file):
+        os.remove(npy_path + ".tmp")
+        return
+
+    # write the metadata first, so that the .npy file is never
+    # seen without it
+    with open(get_power_meta_path(capture_file), "w") as fd:
+        json.dump(meta, fd)
+    os.replace(npy_path + ".tmp", npy_path)
+
+    if os.path.exists(capture_file):
+        os.remove(capture_file)
+    if os.path.isdir(ring_dir):
+        import shutil
+        shutil.rmtree(ring_dir)
+
+    log_this("converted power capture %s: %d samples, %d bytes" % \
+            (npy_path, count, os.path.getsize(npy_path)))
+
+# format a value from a converted power-measurement capture, with
+# the shortest string that has the same value
+def format_power_value(value):
+    value_str = repr(value)
+    if value_str.endswith(".0"):
+        value_str = value_str[:-2]
+    return value_str
+
+# return the CSV data for a converted power-measurement capture
+# (optionally, for only the samples from start to end)
+# The values are the same as in the captured data, but numbers may
+# be formatted differently (e.g. without trailing zeros).
+def get_power_csv_data(capture_file, start=0, end=None):
+    import numpy as np
+
+    records = np.load(get_power_npy_path(capture_file), mmap_mode="r")
+    records = records[start:end]
+    lines = []
+    if start == 0:
+        with open(get_power_meta_path(capture_file)) as fd:
+            meta = json.load(fd)
+        lines.append(meta.get("prefix", "") + meta.get("header", ""))
+    for t, v, c in zip(records["time"].tolist(),
+            records["voltage"].tolist(), records["current"].tolist()):
+        lines.append("%s,%s,%s\n" % (format_power_value(t),
+                format_power_value(v), format_power_value(c)))
+    return "".join(lines)
+
+# write the CSV file for a converted power-measurement capture
+# (if it is not already present)
+def export_power_csv(capture_file):
+    if os.path.exists(capture_file) or \
+            not os.path.exists(get_power_npy_path(capture_file)):
+        return
+
+    with open(capture_file + ".tmp", "w") as fd:
+        fd.write(get_power_csv_data(capture_file))
+    os.replace(capture_file + ".tmp", capture_file)
+
+# load the samples for a power-measurement capture
+# The binary file is memory-mapped, if the capture has been converted.
+# Otherwise, the CSV data is parsed.
+# returns (records, units, msg), where records is an array of
+# samples (with POWER_SAMPLE_DTYPE fields), or None if there are no samples
+def load_power_capture(resource_map, capture_file):
+    import numpy as np
+
+    npy_path = get_power_npy_path(capture_file)
+    if os.path.exists(npy_path):
+        with open(get_power_meta_path(capture_file)) as fd:
+            meta = json.load(fd)
+        records = np.load(npy_path, mmap_mode="r")
+        if not len(records):
+            records = None
+        return (records, meta["units"], "")
+
+    units, msg = get_power_units(resource_map)
+    if msg:
+        return (None, None, msg)
+
+    start, end = get_capture_extent(capture_file)
+    capture_data, start = read_capture_range(capture_file, start,
+            end - start)
+    samples = parse_power_csv(capture_data, start > 0)
+    if samples is None:
+        return (None, units, "")
+
+    records = np.empty(len(samples), dtype=POWER_SAMPLE_DTYPE)
+    records["time"] = samples[:,0]
+    records["voltage"] = samples[:,1]
+    records["current"] = samples[:,2]
+    return (records, units, "")
+
+# reduce the samples in x to min, max and mean values per bucket
+# starts has the index of the first sample in each bucket
+def reduce_power_buckets(np, x, starts):
+    counts = np.diff(np.append(starts, len(x)))
+    return { "min": np.minimum.reduceat(x, starts).round(6).tolist(),
+            "max": np.maximum.reduceat(x, starts).round(6).tolist(),
+            "mean": (np.add.reduceat(x, starts) / counts).round(6).tolist() }
+
+# returns (data, reason), where data has summary statistics for a
+# power-measurement capture, and an optional downsampled series
+# The form may specify:
+#  resolution - the length of each bucket of the series, in seconds
+#  buckets - the number of buckets in the series (instead of resolution)
+# Voltages are reported in V, currents in mA, power in mW and
+# energy in mJ.  Times in the series are relative to the first sample.
+def get_power_stats(req, res_type, resource_map, token, rest):
+    resource = resource_map["name"]
+
+    if res_type != "power-measurement":
+        return (None, "get-stats is only supported for power-measurement resources")
+
+    try:
+        import numpy as np
+    except ImportError:
+        return (None, "Server is missing the 'numpy' module, needed for power-measurement statistics")
+
+    try:
+        resolution = float(req.form.getfirst("resolution", "0"))
+        buckets = int(req.form.getfirst("buckets", "0"))
+    except (ValueError, TypeError):
+        return (None, "Invalid resolution or buckets for get-stats")
+    if not np.isfinite(resolution) or resolution < 0 or buckets < 0:
+        return (None, "Invalid resolution or buckets for get-stats")
+
+    capture_file = get_capture_filepath(req, res_type, resource_map, token)
+
+    if not capture_exists(capture_file):
+        return (None, "Cannot find capture file for resource '%s', token %s" % (resource, token))
+
+    try:
+        records, units, msg = load_power_capture(resource_map, capture_file)
+    except IOError:
+        return (None, "Cannot read capture data for resource '%s', token %s" % (resource, token))
+    except ValueError as e:
+        return (None, "Cannot parse capture data for resource '%s', token %s: %s" % (resource, token, e))
+    if msg:
+        return (None, msg)
+
+    if records is None:
+        return (None, "No power-measurement samples in capture for resource '%s', token %s" % (resource, token))
+
+    t = records["time"] * power_unit_scales["time"][units["time"]]
+    volts = records["voltage"].astype(np.float64) * \
+            power_unit_scales["voltage"][units["voltage"]]
+    amps = records["current"].astype(np.float64) * \
+            power_unit_scales["current"][units["current"]]
+    watts = volts * amps
+
+    # trapezoidal integration of power over time
+    t = t - t[0]
+    duration = float(t[-1])
+    energy = float(np.sum((watts[1:] + watts[:-1]) * np.diff(t)) / 2)
+
+    sample_rate = 0
+    if duration > 0:
+        sample_rate = (len(t) - 1) / duration
+
+    stats = { "samples": len(t),
+            "duration": duration,
+            "sample_rate": sample_rate,
+            "voltage": { "mean": float(volts.mean()),
+                "min": float(volts.min()), "max": float(volts.max()) },
+            "current": { "mean": float(amps.mean()) * 1000,
+                "min": float(amps.min()) * 1000,
+                "max": float(amps.max()) * 1000 },
+            "power": { "mean": float(watts.mean()) * 1000,
+                "max": float(watts.max()) * 1000 },
+            "energy": energy * 1000,
+            "units": { "voltage": "V", "current": "mA", "power": "mW",
+                "energy": "mJ", "duration": "s" } }
+
+    if buckets > POWER_STATS_MAX_BUCKETS:
+        return (None, "Too many buckets (%d) for get-stats (max %d)" % \
+                (buckets, POWER_STATS_MAX_BUCKETS))
+    if buckets > 0 and not resolution:
+        resolution = duration / buckets
+    if resolution > 0:
+        # check the resolution before dividing by it, as a tiny
+        # resolution would make the bucket count overflow
+        if resolution < duration / POWER_STATS_MAX_BUCKETS:
+            return (None, "Resolution %g is too small for get-stats (max %d buckets)" % \
+                    (resolution, POWER_STATS_MAX_BUCKETS))
+        count = int(duration / resolution) + 1
+        if buckets > 0 and resolution == duration / buckets:
+            # put the last sample in the last bucket
+            count = min(count, buckets)
+        if count > POWER_STATS_MAX_BUCKETS:
+            return (None, "Too many buckets (%d) for get-stats (max %d)" % \
+                    (count, POWER_STATS_MAX_BUCKETS))
+
+        # find the first sample in each bucket, and skip empty buckets
+        edges = np.searchsorted(t, np.arange(count) * resolution)
+        nonempty = edges < np.append(edges[1:], len(t))
+        starts = edges[nonempty]
+        stats["series"] = { "resolution": resolution,
+                "time": (np.arange(count)[nonempty] * resolution).round(6).tolist(),
+                "voltage": reduce_power_buckets(np, volts, starts),
+                "current": reduce_power_buckets(np, amps * 1000, starts),
+                "power": reduce_power_buckets(np, watts * 1000, starts) }
+
+    return (stats, "")
 
 # returns url_path, reason
 # url_path is empty on failure, and reason is a string with error message
@@ -4809,9 +8499,27 @@ def get_captured_data_ref(req, res_type, resource_map, token, rest):
 
     capture_file = get_capture_filepath(req, res_type, resource_map, token)
 
-    if not os.path.exists(capture_file):
+    if not capture_exists(capture_file):
         return (None, "Cannot find capture file for resource '%s', token %s" % (resource, token))
 
+    # a converted power-measurement capture is returned as CSV, unless
+    # the binary format is requested with format=npy
+    npy_path = get_power_npy_path(capture_file)
+    if res_type == "power-measurement" and os.path.exists(npy_path):
+        if req.form.getfirst("format", "csv") == "npy":
+            capture_file = npy_path
+        else:
+            export_power_csv(capture_file)
+
+    # put the data from a ring capture into a regular file
+    ring_dir = get_ring_dir(capture_file)
+    if os.path.isdir(ring_dir):
+        import shutil
+        with open(capture_file, "wb") as out:
+            for offset, path, size in get_ring_segments(ring_dir):
+                with open(path, "rb") as fd:
+                    shutil.copyfileobj(fd, out)
+
     filename = os.path.basename(capture_file)
     url_path = req.config.url_prefix + req.config.files_url_base + "/files/" + filename
     return (url_path, "")
@@ -4822,9 +8530,16 @@ def delete_capture(req, res_type, resource_map, token, rest):
 
     capture_file = get_capture_filepath(req, res_type, resource_map, token)
 
-    if not os.path.exists(capture_file):
+    if not capture_exists(capture_file):
         return "Cannot delete captured data for resource '%s'" % resource
-    os.remove(capture_file)
+    for path in [capture_file, get_power_npy_path(capture_file),
+            get_power_meta_path(capture_file), get_index_path(capture_file)]:
+        if os.path.exists(path):
+            os.remove(path)
+    ring_dir = get_ring_dir(capture_file)
+    if os.path.isdir(ring_dir):
+        import shutil
+        shutil.rmtree(ring_dir)
     return ""
 
 def put_data(req, res_type, resource_map, rest):
@@ -4892,7 +8607,8 @@ def return_api_resource_action(req, resource, res_type, rest):
         return
 
     if res_type in ["power-measurement", "serial", "camera", "audio"]:
-        if operation in ["stop-capture", "get-data", "get-ref", "delete"]:
+        if operation in ["stop-capture", "get-data", "get-ref", "get-stats",
+                "delete"]:
             try:
                 token = rest[0]
             except IndexError:
@@ -4929,6 +8645,13 @@ def return_api_resource_action(req, resource, res_type, rest):
                 return
             req.send_api_response(RSLT_OK, { "data": data } )
             return
+        elif operation == "get-stats":
+            data, reason = get_power_stats(req, res_type, resource_map, token, rest[2:])
+            if reason:
+                req.send_api_response_msg(RSLT_FAIL, reason)
+                return
+            req.send_api_response(RSLT_OK, { "data": data } )
+            return
         elif operation == "get-ref":
             data, reason = get_captured_data_ref(req, res_type, resource_map, token, rest[2:])
             if reason:
@@ -4959,11 +8682,334 @@ def return_api_resource_action(req, resource, res_type, rest):
     msg = "resource type '%s' not supported (rest='%s')" % (res_type, rest)
     req.send_api_response_msg(RSLT_FAIL, msg)
 
+# A capture session is a group of captures, on different resources, that
+# are started at the same time, so that their data can be aligned.
+#  - POST api/v0.2/capture-sessions starts captures on the resources in
+#    the 'resources' form field (a comma-separated list of
+#    {resource}[:{type}]), and returns the session data
+#  - GET api/v0.2/capture-sessions/{id} returns the session data
+#  - api/v0.2/capture-sessions/{id}/stop stops all the captures
+#  - api/v0.2/capture-sessions/{id}/get-data returns the data for all
+#    the captures.  Relative start_time and end_time values are relative
+#    to the start of the session.
+#  - api/v0.2/capture-sessions/{id}/delete deletes the captures and
+#    the session (if a capture can't be deleted, the session is kept,
+#    with just the captures that are left)
+# Only the user who started a session can stop it, get its data or
+# delete it.
+# Sessions are stored in {base_dir}/capture-sessions/{id}.json.  The
+# session data has the start time of the session, the user who started
+# it, and for each capture, the resource, type, token and start_offset
+# (the time in seconds from the start of the session to the start of
+# the capture).
+
+CAPTURE_TYPES = ["serial", "power-measurement", "audio", "camera"]
+
+def get_capture_session_path(req, session_id):
+    if not re.match("^[0-9a-f]{32}$", session_id):
+        return None
+    return req.config.base_dir + "/capture-sessions/" + session_id + ".json"
+
+# returns (session, msg), with session=None on failure
+def read_capture_session(req, session_id):
+    path = get_capture_session_path(req, session_id)
+    if not path or not os.path.exists(path):
+        return (None, "Cannot find capture session '%s'" % session_id)
+    with open(path) as fd:
+        return (json.load(fd), "")
+
+def write_capture_session(req, session):
+    path = get_capture_session_path(req, session["id"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fd:
+        json.dump(session, fd, indent=4)
+    os.replace(path + ".tmp", path)
+
+# parse the resource list for a capture session
+# The capture type for a resource is the first capture type in its
+# 'type' field, unless it is specified as {resource}:{type}.
+# returns (captures, msg), where captures is a list of maps with the
+# resource, type and resource_map for each capture
+def get_session_captures(req, resource_list):
+    resources = get_object_list(req, "resource")
+    captures = []
+    for item in resource_list.replace(",", " ").split():
+        resource, sep, res_type = item.partition(":")
+        if resource not in resources:
+            return (None, "Could not find resource '%s' registered with server" % resource)
+        if resource in [capture["resource"] for capture in captures]:
+            continue
+
+        resource_map = get_object_map(req, "resource", resource)
+        if not resource_map:
+            return (None, "Problem loading data for resource '%s'" % resource)
+
+        if not res_type:
+            types = resource_map.get("type", [])
+            if isinstance(types, str):
+                types = [types]
+            for t in types:
+                if t in CAPTURE_TYPES:
+                    res_type = t
+                    break
+        if res_type not in CAPTURE_TYPES:
+            return (None, "Resource '%s' does not support capture" % resource)
+
+        captures.append({ "resource": resource, "type": res_type,
+                "resource_map": resource_map })
+
+    if not captures:
+        return (None, "No resources specified for capture session")
+    return (captures, "")
+
+# start captures on all the resources for a session
+# The captures are started in parallel threads, which wait on a barrier
+# so that they all call start_capture at the same moment.
+def do_start_capture_session(req):
+    from concurrent.futures import ThreadPoolExecutor
+
+    captures, msg = get_session_captures(req,
+            req.form.getfirst("resources", ""))
+    if msg:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    # record the session start when the threads are released
+    session_start = {}
+    def mark_session_start():
+        session_start["monotonic"] = time.monotonic()
+        session_start["time"] = time.time()
+    barrier = threading.Barrier(len(captures), action=mark_session_start)
+
+    def start_session_capture(capture):
+        try:
+            barrier.wait(timeout=30)
+        except threading.BrokenBarrierError:
+            return ("", "Timeout waiting to start capture on resource '%s'" % capture["resource"])
+        try:
+            token, reason = start_capture(req, capture["type"],
+                    capture["resource_map"], [])
+        except Exception as e:
+            token, reason = ("", "Exception starting capture on resource '%s': %s" % (capture["resource"], e))
+        capture["launched"] = time.monotonic()
+        return (token, reason)
+
+    with ThreadPoolExecutor(max_workers=len(captures)) as executor:
+        results = list(executor.map(start_session_capture, captures))
+
+    # if any capture failed to start, remove the others
+    reasons = [reason for token, reason in results if not token]
+    if reasons:
+        for capture, (token, reason) in zip(captures, results):
+            if token:
+                stop_capture(req, capture["type"], capture["resource_map"],
+                        token, [])
+                delete_capture(req, capture["type"], capture["resource_map"],
+                        token, [])
+        msg = "Could not start capture session:\n" + "\n".join(reasons)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    session = { "id": uuid.uuid4().hex, "start_time": session_start["time"],
+            "user": req.get_user(), "captures": [] }
+    for capture, (token, reason) in zip(captures, results):
+        # use the start time from the capture index, if there is one,
+        # as that is what time-range queries use
+        capture_file = get_capture_filepath(req, capture["type"],
+                capture["resource_map"], token)
+        index = read_capture_index(capture_file)
+        if index:
+            start_offset = index[0][0] - session_start["time"]
+        else:
+            start_offset = capture["launched"] - session_start["monotonic"]
+        session["captures"].append({ "resource": capture["resource"],
+                "type": capture["type"], "token": token,
+                "start_offset": round(start_offset, 6) })
+
+    write_capture_session(req, session)
+    log_this("started capture session %s: %s" % (session["id"],
+            ", ".join([capture["resource"] for capture in captures])))
+    req.send_api_response(RSLT_OK, { "data": session })
+
+# run func(capture, resource_map) for each capture in a session, in
+# parallel, and return a map of results for each resource
+# func returns (data, reason), where reason is non-empty on failure
+def run_session_operation(req, session, func):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run_operation(capture):
+        result = { "type": capture["type"], "token": capture["token"],
+                "start_offset": capture["start_offset"] }
+        resource_map = get_object_map(req, "resource", capture["resource"])
+        if not resource_map:
+            data, reason = None, "Problem loading data for resource '%s'" % capture["resource"]
+        else:
+            try:
+                data, reason = func(capture, resource_map)
+            except Exception as e:
+                data, reason = None, "Exception for resource '%s': %s" % (capture["resource"], e)
+        if reason:
+            result["result"] = RSLT_FAIL
+            result["message"] = reason
+        else:
+            result["result"] = RSLT_OK
+        if data is not None:
+            result["data"] = data
+        return result
+
+    captures = session["captures"]
+    with ThreadPoolExecutor(max_workers=len(captures)) as executor:
+        results = list(executor.map(run_operation, captures))
+    return dict(zip([capture["resource"] for capture in captures], results))
+
+# convert a relative time for a session to an absolute time
+# (relative times in a session are relative to the session start)
+def get_session_time(session, time_str):
+    if time_str is None:
+        return None
+    time_str = time_str.strip()
+    if time_str.startswith("@") or ":" in time_str:
+        return time_str
+    try:
+        return "@%.6f" % (session["start_time"] + float(time_str))
+    except ValueError:
+        return time_str
+
+# handle api/v0.2/capture-sessions/...
+def do_capture_session_action(req, rest):
+    method = req.environ.get("REQUEST_METHOD", "GET")
+    if not rest:
+        if method != "POST":
+            msg = "Use POST to start a capture session"
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+        do_start_capture_session(req)
+        return
+
+    session, msg = read_capture_session(req, rest[0])
+    if not session:
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    if len(rest) == 1:
+        req.send_api_response(RSLT_OK, { "data": session })
+        return
+
+    operation = rest[1]
+    owner = session.get("user", None)
+    if owner and owner != req.get_user():
+        msg = "Capture session %s belongs to user '%s'.\nCannot do %s operation." % (session["id"], owner, operation)
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    if operation == "stop":
+        def stop_session_capture(capture, resource_map):
+            return (None, stop_capture(req, capture["type"], resource_map,
+                    capture["token"], []))
+        results = run_session_operation(req, session, stop_session_capture)
+    elif operation == "get-data":
+        start_str = get_session_time(session,
+                req.form.getfirst("start_time", None))
+        end_str = get_session_time(session,
+                req.form.getfirst("end_time", None))
+        if start_str is None:
+            start_str = "@%.6f" % session["start_time"]
+
+        def get_session_capture_data(capture, resource_map):
+            if capture["type"] == "camera":
+                return get_captured_data_ref(req, capture["type"],
+                        resource_map, capture["token"], [])
+            capture_file = get_capture_filepath(req, capture["type"],
+                    resource_map, capture["token"])
+            if not capture_exists(capture_file):
+                return (None, "Cannot find capture file for resource '%s', token %s" % (capture["resource"], capture["token"]))
+            return read_captured_range(req, capture["type"], resource_map,
+                    capture_file, capture["token"], start_str, end_str)
+        results = run_session_operation(req, session,
+                get_session_capture_data)
+    elif operation == "delete":
+        def delete_session_capture(capture, resource_map):
+            capture_file = get_capture_filepath(req, capture["type"],
+                    resource_map, capture["token"])
+            if not capture_exists(capture_file):
+                # already deleted (e.g. by an earlier delete operation)
+                return (None, "")
+            return (None, delete_capture(req, capture["type"], resource_map,
+                    capture["token"], []))
+        results = run_session_operation(req, session, delete_session_capture)
+
+        # keep the session for any captures that were not deleted, so
+        # the delete can be tried again
+        session["captures"] = [capture for capture in session["captures"]
+                if results[capture["resource"]]["result"] != RSLT_OK]
+        if session["captures"]:
+            write_capture_session(req, session)
+        else:
+            os.remove(get_capture_session_path(req, session["id"]))
+    else:
+        msg = "operation '%s' not supported for capture session" % operation
+        req.send_api_response_msg(RSLT_FAIL, msg)
+        return
+
+    failed = [resource for resource, result in results.items()
+            if result["result"] != RSLT_OK]
+    data = { "start_time": session["start_time"], "captures": results }
+    if failed:
+        msg = "capture session %s failed for: %s" % (operation,
+                ", ".join(sorted(failed)))
+        req.send_api_response(RSLT_FAIL, { "message": msg, "data": data })
+        return
+    req.send_api_response(RSLT_OK, { "data": data })
+
+# check the password for user data read from a user file
+# if set_req_user = True, then set req.user appropriately (on success)
+# returns (token, msg), with token=None on failure
+def check_user_password(req, udata, password, set_req_user):
+    user_name = udata["name"]
+    user_password = udata.get("password", "")
+
+    if password != user_password:
+        msg = "Password mismatch on login attempt for user '%s'" % user_name
+        log_this(msg)
+        return (None, "Authentication for user '%s' failed" % user_name)
+
+    log_this("Authenticated user '%s'" % user_name)
+    token = udata.get("auth_token", "")
+    if not token:
+        return (None, "Invalid token for user '%s' on server" % user_name)
+
+    if set_req_user:
+        req.user.name = user_name
+        admin = udata.get("admin", "")
+        if admin == "True":
+            req.user.admin = True
+        else:
+            req.user.admin = False
+    return (token, "")
+
 # returns token, reason - where token is non-empty on success
 # if set_req_user = True, then set req.user appropriately (on success)
 def authenticate_user(req, user, password, set_req_user=False):
-    # scan user files for matching user
     user_dir = req.config.data_dir + "/users"
+
+    # try the user file named after the user first
+    # (the user data is cached by object_cache)
+    if user and "/" not in user and not user.startswith("."):
+        upath = user_dir + "/user-" + user + ".json"
+        udata = {}
+        try:
+            data = object_cache.get_data("user", user, upath)
+            udata = object_cache.get_map("user", user, data)
+        except FileNotFoundError:
+            pass
+        except:
+            log_this("Error reading json data from file %s" % upath)
+
+        if udata.get("name", None) == user:
+            return check_user_password(req, udata, password, set_req_user)
+
+    # fall back to scanning user files for matching user
+    # (for files whose name does not match the user name)
     try:
         user_files = os.listdir( user_dir )
     except:
@@ -4971,20 +9017,20 @@ def authenticate_user(req, user, password, set_req_user=False):
         log_this(msg)
         return None, msg
 
+    msg = "Authentication for user '%s' failed" % user
     for ufile in user_files:
-        if not ufile.startswith("user-"):
+        if not ufile.startswith("user-") or not ufile.endswith(".json"):
             continue
         upath = user_dir + "/" + ufile
-        try:
-            ufd = open(upath)
-        except:
-            log_this("Error opening upath %s" % upath)
+        obj_name = ufile[len("user-"):-5]
+        if obj_name == user:
+            # already checked above
             continue
 
         try:
-            udata = json.load(ufd)
+            data = object_cache.get_data("user", obj_name, upath)
+            udata = object_cache.get_map("user", obj_name, data)
         except:
-            ufd.close()
             log_this("Error reading json data from file %s" % upath)
             continue
 
@@ -4998,77 +9044,22 @@ def authenticate_user(req, user, password, set_req_user=False):
         if user != user_name:
             continue
 
-        # found a match - check password
-        user_password = udata.get("password", "")
-
-        if password == user_password:
-            log_this("Authenticated user '%s'" % user)
-            token = udata.get("auth_token", "")
-            if token:
-                if set_req_user:
-                    req.user.name = user_name
-                    admin = udata.get("admin", "")
-                    if admin == "True":
-                        req.user.admin = True
-                    else:
-                        req.user.admin = False
-                return (token, "")
-            else:
-                return (None, "Invalid token for user '%s' on server" % user)
-        else:
-            msg = "Password mismatch on login attempt for user '%s'" % user
-            log_this(msg)
+        # found a match - check password (and keep looking on failure)
+        token, msg = check_user_password(req, udata, password, set_req_user)
+        if token:
+            return (token, msg)
 
-    return (None, "Authentication for user '%s' failed" % user)
+    return (None, msg)
 
 # find a resource that applies to a particular board feature
 # returns resource, reason - where resource is non-empty on success
 # logs any errors encountered
 def find_resource(req, board, feature):
-    # scan resource files for a match
-    res_dir = req.config.data_dir + "/resources"
-    try:
-        res_files = os.listdir( res_dir )
-    except:
-        msg = "Error: could not read resource files from " + res_dir
-        log_this(msg)
-        return None, msg
-
-    for rfile in res_files:
-        dlog_this("checking rfile %s" % rfile)
-        if not rfile.startswith("resource-"):
-            continue
-        rpath = res_dir + "/" + rfile
-        try:
-            rfd = open(rpath)
-        except:
-            log_this("Error opening rpath %s" % rpath)
-            continue
-
-        try:
-            rdata = json.load(rfd)
-        except:
-            rfd.close()
-            log_this("Error reading json data from file %s" % rpath)
-            continue
-
-        dlog_this("in find_resource...: rdata= %s" % rdata)
-        try:
-            rboard = rdata["board"]
-        except:
-            dlog_this("resource file '%s' is missing 'board' field" % rpath)
-            continue
-
-        if board != rboard:
-            continue
-
-        # found a match - check board-endpoint against feature string
-        board_feature = rdata.get("board_feature", "")
-
-        dlog_this("feature=%s, board_feature=%s" % (feature, board_feature))
-
-        if feature == board_feature:
-            return (rdata["name"], None)
+    # look up the board and feature in the resource index
+    resource = resource_index.find(req, board, feature)
+    dlog_this("in find_resource: %s:%s -> %s" % (board, feature, resource))
+    if resource:
+        return (resource, None)
 
     return (None, "No match found for '%s:%s'" % (board, feature))
 
@@ -5081,6 +9072,16 @@ def find_resource(req, board, feature):
 # {board} release force -> api/v0.2/devices/{board}/release"
 # {board} status -> api/v0.2/devices/{board}
 # {board} get_resource -> api/v0.2/devices/{board}/get_resource/{resource_type}
+# farm-status -> api/v0.2/farm-status
+# (event stream) -> api/v0.2/events[?board={board}]
+# (start job) -> POST api/v0.2/devices/{board}/jobs
+# (job output) -> api/v0.2/jobs/{job_id}?offset={n}&err_offset={n}
+# (check for uploaded file) -> api/v0.2/blobs/{sha256}
+# (upload to multiple boards) -> POST api/v0.2/multi-upload
+# (resumable upload) -> api/v0.2/upload-sessions/{id}/...
+# (supported compression codecs) -> api/v0.2/codecs
+# capture-session start -> POST api/v0.2/capture-sessions
+# capture-session {stop,get-data,delete} -> api/v0.2/capture-sessions/{id}/{operation}
 # {resource} pm start -> api/v0.2/resources/{resource}/power-measurement/start-capture
 # {resource} pm stop -> api/v0.2/resources/{resource}/power-measurement/stop-capture/token
 # {resource} pm get-data -> api/v0.2/resources/{resource}/power-measurement/get-data/token
@@ -5149,6 +9150,46 @@ def do_api(req):
         req.send_api_response(RSLT_OK, { "data": { "token": token } } )
         return
 
+    if parts[0] == "farm-status":
+        return_api_farm_status(req)
+        return
+
+    if parts[0] == "events":
+        return_api_events(req)
+        return
+
+    if parts[0] == "blobs":
+        if len(parts) < 2:
+            msg = "Missing sha256 hash after /api/v0.2/blobs"
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+        return_api_blob(req, parts[1])
+        return
+
+    if parts[0] == "codecs":
+        return_api_codecs(req)
+        return
+
+    if parts[0] == "upload-sessions":
+        do_upload_session_action(req, parts[1:])
+        return
+
+    if parts[0] == "multi-upload":
+        do_multi_upload(req)
+        return
+
+    if parts[0] == "capture-sessions":
+        do_capture_session_action(req, parts[1:])
+        return
+
+    if parts[0] == "jobs":
+        if len(parts) < 2:
+            msg = "Missing job id after /api/v0.2/jobs"
+            req.send_api_response_msg(RSLT_FAIL, msg)
+            return
+        return_api_job(req, parts[1], parts[2:])
+        return
+
     if parts[0] == "devices":
         if len(parts) == 1:
             # handle /api/devices - list devices
@@ -5346,23 +9387,10 @@ def handle_request(environ, req):
     if not req.footer_shown:
         req.show_footer()
 
-def cgi_main():
-    #dlog_this("os.environ='%s'" % os.environ)
-    #dlog_this("stdin='%s'" % sys.stdin.read())
-    # handle json data myself, as the cgi module has a bug with
-    # data submitted via the requests module as application/json
-    if os.environ.get("CONTENT_TYPE", "") == "application/json":
-        bin_data = sys.stdin.buffer.read()
-        #dlog_this("incoming json form data='%s'" % data)
-        form = mycgiform_class(bin_data)
-    else:
-        form = cgi.FieldStorage()
-
-    req = req_class(config, form)
-    req.is_cgi = True
-
+# run the request, converting any exception into an error page
+def run_request(environ, req):
     try:
-        handle_request(os.environ, req)
+        handle_request(environ, req)
     except SystemExit:
         pass
     except:
@@ -5379,14 +9407,148 @@ def cgi_main():
         log_this("LabControl Server Error")
         log_this("traceback=%s" % tb_msg)
 
-
-    # output html to stdout
-    for line in req.html:
-        print(line)
-        if debug_api_response:
+    if debug_api_response:
+        for line in req.html:
             dlog_this(line)
 
-    sys.stdout.flush()
+def cgi_main():
+    #dlog_this("os.environ='%s'" % os.environ)
+    #dlog_this("stdin='%s'" % sys.stdin.read())
+    # handle json data myself, as the cgi module has a bug with
+    # data submitted via the requests module as application/json
+    content_type = os.environ.get("CONTENT_TYPE", "").split(";")[0].strip()
+    if content_type in ["application/json", "application/octet-stream"]:
+        try:
+            content_len = int(os.environ.get("CONTENT_LENGTH") or -1)
+        except ValueError:
+            content_len = -1
+        form = mycgiform_class(fp=sys.stdin.buffer, length=content_len,
+                query_string=os.environ.get("QUERY_STRING", ""))
+    else:
+        form = cgi.FieldStorage()
+
+    req = req_class(config, form)
+    req.is_cgi = True
+
+    run_request(os.environ, req)
+
+    if req.stream is None:
+        # output html to stdout
+        for line in req.html:
+            print(line)
+        sys.stdout.flush()
+        return
+
+    # output streamed data directly, as binary data
+    out = sys.stdout.buffer
+    for name, value in req.stream_headers:
+        out.write(("%s: %s\n" % (name, value)).encode("utf-8"))
+    out.write(b"\n")
+    for chunk in req.stream:
+        out.write(chunk)
+        out.flush()
+
+# WSGI entry point
+# This can be used with any WSGI server (e.g. mod_wsgi, gunicorn, uwsgi),
+# to avoid the overhead of starting a new python process for each request.
+# e.g. 'gunicorn --threads 8 lcserver:application'
+def application(environ, start_response):
+    # python's cgi module uses os.environ for the query string, so
+    # make sure the form is built from the WSGI environ instead
+    content_type = environ.get("CONTENT_TYPE", "").split(";")[0].strip()
+    if content_type in ["application/json", "application/octet-stream"]:
+        try:
+            content_len = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            content_len = 0
+        form = mycgiform_class(fp=environ["wsgi.input"], length=content_len,
+                query_string=environ.get("QUERY_STRING", ""))
+    else:
+        form_env = {}
+        for key in ["REQUEST_METHOD", "QUERY_STRING", "CONTENT_TYPE",
+                "CONTENT_LENGTH"]:
+            if key in environ:
+                form_env[key] = environ[key]
+        # (blank values are dropped, as they are in the CGI case)
+        form = cgi.FieldStorage(fp=environ.get("wsgi.input"),
+                environ=form_env)
+
+    req = req_class(config, form)
+
+    run_request(environ, req)
+
+    status, headers, body = req.get_response()
+    start_response(status, headers)
+    return body
+
+# create a request object, for work done outside of a client request
+# (e.g. by the status poller)
+def make_internal_req():
+    req = req_class(config, mycgiform_class(b""))
+    req.environ = {}
+    req.user = user_class()
+    return req
+
+# run the status poller in the foreground
+def poll_main():
+    poller = status_poller_class(config)
+    print("Polling board status every %s seconds (jitter %s)" % \
+            (config.status_poll_interval, config.status_poll_jitter))
+    try:
+        poller.run()
+    except KeyboardInterrupt:
+        pass
+
+# run a standalone server, using the WSGI application
+# this is intended for lab-local use and testing
+def serve(port):
+    from wsgiref.simple_server import make_server, WSGIServer
+    from socketserver import ThreadingMixIn
+
+    class threading_server_class(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    server = make_server("", port, application,
+            server_class=threading_server_class)
+
+    # poll board status in the background, if enabled
+    poller = None
+    try:
+        poll_interval = float(config.status_poll_interval)
+    except ValueError:
+        log_this("Invalid status_poll_interval '%s', using 60" % \
+                config.status_poll_interval)
+        poll_interval = 60.0
+    if poll_interval > 0:
+        poller = status_poller_class(config)
+        poller.start()
+    log_this("Serving lcserver on port %d" % port)
+    print("Serving lcserver on port %d (url_base=%s)" % (port,
+            config.url_base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    if poller:
+        poller.stop()
 
 if __name__=="__main__":
-    cgi_main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        try:
+            port = int(sys.argv[2])
+        except (IndexError, ValueError):
+            port = 8000
+        serve(port)
+    elif len(sys.argv) > 1 and sys.argv[1] == "--poll":
+        poll_main()
+    elif len(sys.argv) > 2 and sys.argv[1] == "--run-job":
+        run_job(sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == "--ring-writer":
+        run_ring_writer(sys.argv[2])
+    elif len(sys.argv) > 3 and sys.argv[1] == "--convert-power":
+        run_power_conversion(sys.argv[2], json.loads(sys.argv[3]))
+    elif len(sys.argv) > 4 and sys.argv[1] == "--capture-index":
+        run_capture_indexer(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
+    else:
+        cgi_main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# sync-manifest-test.py - check that a directory sync can't change files
+# outside of the sync tree, through a link in the tree
+#
+# This test does not need a lab or a running server.  It loads
+# lcserver.py (from the directory above this one), and runs the
+# manifest checks and apply_sync_manifest() on a scratch directory.
+#
+# outline:
+#  make a sync tree with link 'a', pointing to a directory outside the tree
+#  check that a manifest with entries under 'a' is rejected
+#  apply the manifest anyway, and check that the outside directory
+#    is not changed, and that the problems are reported
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import importlib.util
+
+TC_NUM = 0
+FAIL_COUNT = 0
+
+def ok(desc, result):
+    global TC_NUM, FAIL_COUNT
+    TC_NUM += 1
+    if result:
+        print("ok %d - %s" % (TC_NUM, desc))
+    else:
+        print("not ok %d - %s" % (TC_NUM, desc))
+        FAIL_COUNT += 1
+    return result
+
+def load_lcserver():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            "..", "lcserver.py")
+    spec = importlib.util.spec_from_file_location("lcserver", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main():
+    lcserver = load_lcserver()
+
+    print("TAP version 13")
+    print("1..4")
+
+    scratch = tempfile.mkdtemp(prefix="lc-sync-test-")
+    outside = scratch + "/outside"
+    os.makedirs(outside + "/existing")
+    os.chmod(outside + "/existing", 0o755)
+
+    root = scratch + "/tree"
+    new_dir = scratch + "/new"
+    os.makedirs(root)
+    os.makedirs(new_dir)
+    os.symlink(outside, root + "/a")
+
+    manifest = { "a": { "type": "link", "target": outside },
+            "a/existing": { "type": "dir", "mode": "777" },
+            "a/newdir": { "type": "dir", "mode": "755" } }
+
+    try:
+        lcserver.check_sync_manifest(manifest)
+        rejected = False
+    except ValueError:
+        rejected = True
+    ok("manifest with entries under a link is rejected", rejected)
+
+    problems = lcserver.apply_sync_manifest(root, new_dir, manifest)
+    ok("apply_sync_manifest reports entries outside the tree",
+            len(problems) == 2)
+    ok("no directory is created outside the tree",
+            not os.path.exists(outside + "/newdir"))
+    mode = os.stat(outside + "/existing").st_mode & 0o777
+    ok("directory outside the tree keeps its mode", mode == 0o755)
+
+    shutil.rmtree(scratch)
+    return FAIL_COUNT
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)